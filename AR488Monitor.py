@@ -1,3 +1,4 @@
+import queue
 import serial
 import threading
 import time
@@ -7,62 +8,137 @@ PORT = '/dev/cu.usbserial-10'   # Update this to your serial port
 BAUDRATE = 115200
 APPEND_CR = True     # Append carriage return (\r)
 APPEND_LF = False    # Append line feed (\n)
+
+MAX_BUFFER = 4096    # Bytes kept for a line that has not been terminated yet
+MAX_LINES = 1024     # Received lines kept until someone reads them
+READ_TIMEOUT = 0.1   # Seconds a blocking read waits, bounds how long close() takes
+# Controller mode, device responses only on ++read, EOI asserted and CR+LF appended on writes to devices
+CONTROLLER_SETUP = ("++mode 1", "++auto 0", "++eoi 1", "++eos 0")
 # ======================
 
 class AR488Monitor:
-    def __init__(self, port=PORT, baudrate=BAUDRATE, append_cr=APPEND_CR, append_lf=APPEND_LF):
+    def __init__(self, port=PORT, baudrate=BAUDRATE, append_cr=APPEND_CR, append_lf=APPEND_LF, echo=True):
         self.port = port
         self.baudrate = baudrate
         self.append_cr = append_cr
         self.append_lf = append_lf
+        self.echo = echo
         self.ser = None
-        self._buffer = ""
+        self._rx = bytearray()                        # Partial line, bounded by MAX_BUFFER
+        self._lines = queue.Queue(maxsize=MAX_LINES)  # Complete lines, terminators stripped
+        self._recent = []                             # Lines since the last write, for get_buffer()
         self._stop_reader = False
+        self.failed = False                           # Set once the port reports an error
         self._lock = threading.Lock()
         self._connect()
         self._start_reader()
 
 
     def _connect(self):
-        self.ser = serial.Serial(self.port, self.baudrate, timeout=0.1)
+        self.ser = serial.Serial(self.port, self.baudrate, timeout=READ_TIMEOUT)
         time.sleep(2)  # Let device reset
         print(f"✅ Connected to {self.port} at {self.baudrate} baud.")
 
     def _start_reader(self):
-        thread = threading.Thread(target=self._read_from_serial, daemon=True)
-        thread.start()
+        self._thread = threading.Thread(target=self._read_from_serial, daemon=True)
+        self._thread.start()
 
     def _read_from_serial(self):
         while not self._stop_reader:
             try:
-                if self.ser.in_waiting:
-                    data = self.ser.read(self.ser.in_waiting).decode(errors='ignore')
-                    with self._lock:
-                        self._buffer += data
-                    print(data, end='', flush=True)
+                # Blocks until at least one byte arrives or READ_TIMEOUT passes
+                data = self.ser.read(self.ser.in_waiting or 1)
             except Exception as e:
+                if self._stop_reader:
+                    break
+                self.failed = True
                 print(f"[Read error]: {e}")
-            time.sleep(0.01)
+                time.sleep(READ_TIMEOUT)
+                continue
+            if data:
+                self._frame(data)
+
+    def _frame(self, data: bytes):
+        """Splits received bytes into lines and queues every complete one."""
+        with self._lock:
+            self._rx += data
+            while True:
+                end = self._rx.find(b'\n')
+                if end < 0:
+                    break
+                line = self._rx[:end].rstrip(b'\r').decode(errors='ignore')
+                del self._rx[:end + 1]
+                self._push(line)
+            if len(self._rx) > MAX_BUFFER:
+                # A device that never terminates its output, keep the newest bytes only
+                del self._rx[:len(self._rx) - MAX_BUFFER]
 
+    def _push(self, line: str):
+        if self.echo:
+            print(line, flush=True)
+        self._recent.append(line)
+        if len(self._recent) > MAX_LINES:
+            del self._recent[0]
+        if self._lines.full():
+            try:
+                self._lines.get_nowait()  # Drop the oldest unread line
+            except queue.Empty:
+                pass
+        self._lines.put_nowait(line)
+
+    def _clear(self):
+        with self._lock:
+            self._recent = []
+            while True:
+                try:
+                    self._lines.get_nowait()
+                except queue.Empty:
+                    break
 
     def write(self, command: str):
         """Write a command to the serial port and reset response buffer."""
-        with self._lock:
-            self._buffer = ""  # clear previous response
+        self._clear()  # clear previous response
         if self.append_cr:
             command += '\r'
         if self.append_lf:
             command += '\n'
         self.ser.write(command.encode())
 
+    def read_line(self, timeout: float = 1.0)->str:
+        """Returns the next received line, or None if none arrives within timeout seconds."""
+        try:
+            return self._lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def query(self, command: str, timeout: float = 1.0)->str:
+        """Sends a command and returns its response line as soon as the terminator arrives.
+           Returns None if nothing arrives within timeout seconds."""
+        self.write(command)
+        line = self.read_line(timeout)
+        return line.strip() if line is not None else None
+
+    def query_lines(self, command: str, timeout: float = 1.0, idle: float = 0.05)->list:
+        """Sends a command with a multi-line response, such as ++fndl, and collects lines
+           until none has arrived for `idle` seconds after the first one."""
+        self.write(command)
+        lines = []
+        line = self.read_line(timeout)
+        while line is not None:
+            if line.strip():
+                lines.append(line.strip())
+            line = self.read_line(idle)
+        return lines
+
     def get_buffer(self) -> str:
         """Return the latest buffered response (since last write)."""
         with self._lock:
-            return self._buffer.strip()
+            return ('\n'.join(self._recent) + '\n' + self._rx.decode(errors='ignore')).strip()
 
     def close(self):
         self._stop_reader = True  # tell thread to exit cleanly
-        time.sleep(0.05)          # short pause to allow thread to exit
+        if getattr(self, '_thread', None) is not None:
+            self._thread.join(timeout=READ_TIMEOUT * 2)
         if self.ser and self.ser.is_open:
             self.ser.close()
             print("🔌 Serial port closed.")
@@ -75,42 +151,115 @@ class AR488Monitor:
                 if line.lower() in ["exit", "quit"]:
                     break
                 self.write(line)
-                time.sleep(0.1)
+                self.read_line(timeout=1.0)
                 print(f"\n📦 Response Buffer:\n{self.get_buffer()}\n")
         except (KeyboardInterrupt, EOFError):
             pass
         finally:
             self.close()
 
+class AR488Connection:
+    """Long-lived, shared AR488 connection.
+       The port is opened (and the board reset waited out) once, callers take the lock for exclusive access,
+       the current ++addr is remembered so repeated queries to one device skip the address switch, and a
+       failed port is reopened and the operation retried once. The adapter is kept in controller mode with
+       ++auto 0, so device responses are fetched with an explicit ++read and plain writes never wait for one."""
+    def __init__(self, port=PORT, baudrate=BAUDRATE):
+        self.port = port
+        self.baudrate = baudrate
+        self.lock = threading.RLock()
+        self.monitor = None
+        self.address = None
+
+    def _ensure(self)->AR488Monitor:
+        if self.monitor is not None and (self.monitor.failed or not self.monitor.ser.is_open):
+            print(f"AR488 on {self.port} failed, reconnecting...")
+            self._drop()
+        if self.monitor is None:
+            self.monitor = AR488Monitor(self.port, self.baudrate, echo=False)
+            self.address = None  # Unknown after a reset
+            for command in CONTROLLER_SETUP:
+                self.monitor.write(command)
+        return self.monitor
+
+    def _drop(self):
+        if self.monitor is not None:
+            try:
+                self.monitor.close()
+            except Exception:
+                pass
+        self.monitor = None
+        self.address = None
+
+    def _run(self, operation):
+        """Runs operation(monitor) under the lock, reconnecting and retrying once if the port fails."""
+        with self.lock:
+            try:
+                return operation(self._ensure())
+            except (serial.SerialException, OSError) as e:
+                print(f"AR488 error: {e}, reconnecting...")
+                self._drop()
+                return operation(self._ensure())
+
+    def _select(self, monitor: AR488Monitor, address):
+        if address is None:
+            return
+        address = str(address).strip()
+        if address != self.address:
+            monitor.write(f"++addr {address}")
+            self.address = address
+
+    def write(self, command: str, address=None):
+        def operation(monitor):
+            self._select(monitor, address)
+            monitor.write(command)
+        self._run(operation)
+
+    def read(self, address=None, timeout: float = 1.0)->str:
+        """Reads one response line from the device at address (the current one if None), None on timeout."""
+        def operation(monitor):
+            self._select(monitor, address)
+            return monitor.query("++read eoi", timeout)
+        return self._run(operation)
+
+    def query(self, command: str, address=None, timeout: float = 1.0)->str:
+        """Sends command to the device at address (the current one if None) and returns its response line.
+           Adapter commands such as ++spoll are answered by the adapter itself."""
+        def operation(monitor):
+            self._select(monitor, address)
+            if command.startswith("++"):
+                return monitor.query(command, timeout)
+            monitor.write(command)
+            return monitor.query("++read eoi", timeout)
+        return self._run(operation)
+
+    def query_lines(self, command: str, timeout: float = 1.0, idle: float = 0.05)->list:
+        return self._run(lambda monitor: monitor.query_lines(command, timeout, idle))
+
+    def close(self):
+        with self.lock:
+            self._drop()
+
+_connections = {}
+_connectionsLock = threading.Lock()
+
+def get_connection(port=PORT, baudrate=BAUDRATE)->AR488Connection:
+    """Returns the shared connection for a port. The port itself is opened on first use."""
+    with _connectionsLock:
+        connection = _connections.get(port)
+        if connection is None:
+            connection = AR488Connection(port, baudrate)
+            _connections[port] = connection
+        return connection
+
 # Example usage
 if __name__ == "__main__":
     monitor = AR488Monitor()
     # monitor.write("++verbose 0")
-    monitor.write("++fndl")
-    time.sleep(0.5)
-    print(monitor.get_buffer())
-    monitor.close()
+    print(monitor.query_lines("++fndl"))
     
-    monitor = AR488Monitor()
-    monitor.write("++addr 5")
-    time.sleep(0.5)
-    monitor.write("*IDN?")
-    time.sleep(1.0)
-    response = monitor.get_buffer()
-    print("Device responded:", response)
-    
-    monitor.write("++addr 7")
-    time.sleep(0.5)
-    monitor.write("*IDN?")
-    time.sleep(1.0)
-    response = monitor.get_buffer()
-    print("Device responded:", response)
-    
-    monitor.write("++addr 5")
-    time.sleep(0.5)
-    monitor.write("*IDN?")
-    time.sleep(1.0)
-    response = monitor.get_buffer()
-    print("Device responded:", response)
+    for address in (5, 7, 5):
+        monitor.write(f"++addr {address}")  # No response to wait for
+        response = monitor.query("*IDN?")
+        print("Device responded:", response)
     monitor.close()
-
@@ -0,0 +1,59 @@
+import asyncio
+
+from metrics import now_ns
+from transport import Transport
+from idIndex import VersionedIDSet
+from handlerFunctions import getProfile, configureSteps, sortCycleSteps, DEFAULT_PROFILE, CONFIGURE_TIME
+
+async def configure(transport: Transport, stopEvent=None)->Transport:
+    """Same exchange as handlerFunctions.configure(), over any Transport."""
+    start = now_ns()
+    await transport.run(configureSteps(), stopEvent)
+    CONFIGURE_TIME.since(start)
+    return transport
+
+async def sortCycle(transport: Transport, IDset, passBin=1, failBin=2, onResult=None, profile=DEFAULT_PROFILE,
+                    stopEvent=None)->list:
+    """One handler index, single or multi-site depending on the profile, returns the bins in site order.
+       Runs the same handlerFunctions.sortCycleSteps() as the synchronous sort loop, so the list is empty once
+       the lot has ended or stopEvent was set while waiting for the part."""
+    return await transport.run(sortCycleSteps(IDset, passBin, failBin, onResult, profile), stopEvent)
+
+async def runLot(transport: Transport, numParts: int, IDset=None, progress=None, stopEvent=None, onResult=None,
+                 profile=DEFAULT_PROFILE):
+    """Configures the handler and sorts up to numParts chips, like handlerFunctions.main()."""
+    profile = getProfile(profile)
+    if IDset is None:
+        IDset = set()
+    await configure(transport, stopEvent)
+    partsDone = 0
+    while partsDone < numParts:
+        if stopEvent is not None and stopEvent.is_set():
+            print(f"Stop requested after {partsDone} parts.")
+            break
+        cycleIDs = IDset.snapshot() if isinstance(IDset, VersionedIDSet) else IDset
+        bins = await sortCycle(transport, cycleIDs, onResult=onResult, profile=profile, stopEvent=stopEvent)
+        if not bins:
+            break
+        partsDone += len(bins)
+        if progress is not None:
+            for bin in bins:
+                progress(bin)
+    return partsDone
+
+async def runLots(jobs: list)->list:
+    """Sorts several handlers concurrently from one event loop. jobs is a list of runLot() keyword dicts,
+       each with its own transport, results come back in the same order."""
+    return await asyncio.gather(*(runLot(**job) for job in jobs))
+
+def main(GPIBaddr: str, numParts: int = 30000, IDset=None, progress=None, stopEvent=None, onResult=None,
+         profile=DEFAULT_PROFILE, srqDispatcher=None, transportFactory=None):
+    """handlerFunctions.main() over transportFactory(GPIBaddr), run as a JobManager job on the job's own thread.
+       srqDispatcher is unused, transports wait for service requests themselves."""
+    async def run():
+        transport = transportFactory(GPIBaddr)
+        try:
+            await runLot(transport, numParts, IDset, progress, stopEvent, onResult, profile)
+        finally:
+            await transport.close()
+    asyncio.run(run())
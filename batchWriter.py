@@ -0,0 +1,97 @@
+import abc
+import atexit
+import queue
+import threading
+import time
+
+class BatchWriter(abc.ABC):
+    """Queues items in memory and writes them in batches from a background thread.
+       Subclasses implement _write(batch), and may open and close what they write to in _start() and _stop(),
+       which run on the writer thread. A batch holds at most batchSize items and is written as soon as the
+       writer is idle, or flushInterval seconds at most after its first item. Anything still queued is
+       written out when the process exits. If _start() fails the writer is closed and put() drops items."""
+    def __init__(self, flushInterval: float, batchSize: int):
+        self.flushInterval = flushInterval
+        self.batchSize = batchSize
+        self._queue = queue.SimpleQueue()
+        self._closed = False
+        self._flushed = threading.Condition()
+        self._pending = 0
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()  # _start() has run before the first caller uses the writer
+        atexit.register(self.close)
+
+    def put(self, item):
+        """Queues an item, this never blocks on the writer."""
+        if self._closed:
+            return
+        with self._flushed:
+            self._pending += 1
+        self._queue.put(item)
+
+    def flush(self, timeout: float = 5.0):
+        """Blocks until every queued item has been written."""
+        deadline = time.monotonic() + timeout
+        with self._flushed:
+            while self._pending and self._thread.is_alive():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._queue.put(None)  # Wake the writer without waiting for the flush interval
+                self._flushed.wait(remaining)
+
+    def close(self):
+        if self._closed:
+            return
+        self.flush()
+        self._closed = True
+        self._queue.put(StopIteration)
+        self._thread.join(timeout=5.0)
+
+    def _start(self):
+        pass
+
+    @abc.abstractmethod
+    def _write(self, batch: list):
+        """Writes one batch, on the writer thread."""
+
+    def _stop(self):
+        pass
+
+    def _run(self):
+        try:
+            self._start()
+        except Exception as e:
+            print(f"{type(self).__name__} failed to start, dropping everything written to it: {e}")
+            self._closed = True
+            return
+        finally:
+            self._ready.set()
+        running = True
+        while running:
+            try:
+                first = self._queue.get(timeout=self.flushInterval)
+            except queue.Empty:
+                continue
+            batch = []
+            for item in self._drain(first):
+                if item is StopIteration:
+                    running = False
+                elif item is not None:
+                    batch.append(item)
+            if batch:
+                self._write(batch)
+            with self._flushed:
+                self._pending -= len(batch)
+                self._flushed.notify_all()
+        self._stop()
+
+    def _drain(self, first):
+        yield first
+        for _ in range(self.batchSize - 1):
+            try:
+                yield self._queue.get_nowait()
+            except queue.Empty:
+                return
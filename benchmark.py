@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time
+
+import handlerFunctions
+import commLog
+import metrics
+from listDevicesUSB import list_usb_devices
+from simHandler import SimHandler, SimResourceManager
+
+ADDRESS = "GPIB0::5::INSTR"
+# What rpiSort.py imports besides D-Bus/GLib, and the dependencies that should stay unloaded until first use
+STARTUP_MODULES = ["jobExecutor", "deviceInventory", "uploadProtocol", "resultStream", "metrics", "gpib_usb_configure"]
+HEAVY_MODULES = ["pyvisa", "pandas", "numpy", "openpyxl"]
+ADVERTISED = "GATT advertisement registered"
+STARTUP_SCRIPT = """
+import json, os, sys, tempfile, time
+start = time.perf_counter()
+for name in {modules!r}:
+    __import__(name)
+imports = time.perf_counter() - start
+result = {{"imports": imports, "service": None, "scanning": None}}
+try:
+    import resultsDb
+    resultsDb._db = resultsDb.ResultsDb(os.path.join(tempfile.mkdtemp(), "results.sqlite3"))  # Not the real one
+    import rpiSort
+    from service import Application
+    app = Application()
+    service = rpiSort.BLEService(0)
+    app.add_service(service)
+    app.compile()
+    result["service"] = time.perf_counter() - start
+    result["scanning"] = any(getattr(c, "inventory", None) is not None and c.inventory.started()
+                             for c in service.get_characteristics())
+except Exception as e:
+    result["error"] = f"{{type(e).__name__}}: {{e}}"
+result["rss"] = next(int(line.split()[1]) for line in open('/proc/self/status') if line.startswith('VmRSS:'))
+result["loaded"] = [m for m in {heavy!r} if m in sys.modules]
+print(json.dumps(result))
+"""
+
+class Measure:
+    """Wall clock and CPU time of a block, with console output swallowed since it is not what is being measured."""
+    def __enter__(self):
+        self._quiet = contextlib.redirect_stdout(io.StringIO())
+        self._quiet.__enter__()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        self.wall = time.perf_counter() - self._wall
+        self.cpu = time.process_time() - self._cpu
+        self._quiet.__exit__(*exc)
+
+    def cpu_percent(self)->float:
+        return 100.0 * self.cpu / self.wall if self.wall else 0.0
+
+def sim_options(args)->dict:
+    return dict(writeLatency=args.latency, readLatency=args.latency, pollLatency=args.latency / 4,
+                indexTime=args.index_time)
+
+def bench_configure(args):
+    handler = SimHandler(**sim_options(args))
+    rm = SimResourceManager({ADDRESS: handler})
+    with Measure() as m:
+        handlerFunctions.configure(ADDRESS, rm=rm)
+    print(f"configure: {m.wall * 1000:.1f} ms, {handler.transactions} transactions, CPU {m.cpu_percent():.0f}%")
+
+def bench_sort(args):
+    results = []
+    for name, profile in handlerFunctions.HANDLER_PROFILES.items():
+        sites = args.sites if profile.multiSite else 1
+        ids = [f"SIM{i:08d}" for i in range(args.parts)]
+        accepted = set(ids[::2])
+        handler = SimHandler(ids=ids, sites=sites, **sim_options(args))
+        rm = SimResourceManager({ADDRESS: handler})
+        with Measure():
+            inst = handlerFunctions.configure(ADDRESS, rm=rm)
+        handler.transactions = 0
+        with Measure() as m:
+            handlerFunctions.runLot(inst, args.parts, accepted, None, None, None, profile)
+        parts = len(handler.binned)
+        wrong = sum(1 for ID, bin in handler.binned if bin != (1 if ID in accepted else 2))
+        results.append((name, parts, handler.transactions / parts, m, wrong))
+    base = results[0][1] / results[0][3].wall
+    for name, parts, transactions, m, wrong in results:
+        rate = parts / m.wall
+        print(f"sort {name:>10}: {transactions:.1f} transactions/part, {m.wall * 1000 / parts:.2f} ms/part, "
+              f"{rate * 3600:.0f} parts/hour ({rate / base:.2f}x), CPU {m.cpu_percent():.0f}%"
+              + (f", {wrong} MISSORTED" if wrong else ""))
+
+def bench_scan(args):
+    present = {f"GPIB0::{pad}::INSTR": SimHandler(idn=f"SIM INSTRUMENT {pad}", **sim_options(args))
+               for pad in args.scan_devices}
+    rm = SimResourceManager(present)
+    with Measure() as m:
+        found = list_usb_devices(rm=rm)
+    print(f"scan: {len(found)}/{len(present)} devices in {m.wall * 1000:.1f} ms, CPU {m.cpu_percent():.0f}%")
+
+def rss_kb(pid)->int:
+    with open(f"/proc/{pid}/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS:"))
+
+def bench_startup(args):
+    """Import time, time to build the GATT service objects and resident memory in a fresh interpreter, without
+       registering with BlueZ. With --full the real service is started and timed until BlueZ registers the
+       advertisement, which needs D-Bus and BlueZ."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT.format(modules=STARTUP_MODULES, heavy=HEAVY_MODULES)
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], cwd=here, capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+    result = json.loads(output.stdout.strip().splitlines()[-1])
+    if result["service"] is not None:
+        service = (f"service objects built at {result['service'] * 1000:.0f} ms, "
+                   f"device scan {'started' if result['scanning'] else 'deferred'}")
+    else:
+        service = f"service objects not built ({result['error']})"
+    print(f"startup imports: {result['imports'] * 1000:.0f} ms, {service} ({wall * 1000:.0f} ms with interpreter), "
+          f"RSS {result['rss'] / 1024:.1f} MB, heavy modules loaded: {', '.join(result['loaded']) or 'none'}")
+    if not args.full:
+        return
+
+    start = time.perf_counter()
+    service = subprocess.Popen([sys.executable, "-u", "rpiSort.py"], cwd=here, stdout=subprocess.PIPE,
+                               stderr=subprocess.STDOUT, text=True)
+    try:
+        for line in service.stdout:
+            if ADVERTISED in line:
+                print(f"startup time-to-advertise: {(time.perf_counter() - start) * 1000:.0f} ms, "
+                      f"RSS {rss_kb(service.pid) / 1024:.1f} MB")
+                break
+        else:
+            print(f"startup: service exited with {service.wait()} before advertising")
+    finally:
+        service.terminate()
+        service.wait()
+
+def print_phases():
+    for name, h in metrics.snapshot()["histograms"].items():
+        if h["count"]:
+            print(f"  {name:>10}: n={h['count']} p50={h['p50']}ms p95={h['p95']}ms p99={h['p99']}ms max={h['max']}ms")
+
+BENCHMARKS = {"configure": bench_configure, "sort": bench_sort, "scan": bench_scan, "startup": bench_startup}
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput of configure, sorting and device scanning against a simulated handler")
+    parser.add_argument("benchmarks", nargs="*", help=f"any of {', '.join(BENCHMARKS)}, all by default")
+    parser.add_argument("--parts", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.002, help="seconds per bus transaction")
+    parser.add_argument("--index-time", type=float, default=0.0, help="seconds the handler needs per index")
+    parser.add_argument("--sites", type=int, default=4, help="occupied sites for multi-site profiles")
+    parser.add_argument("--srq-mode", default="auto", help="event, poll or auto")
+    parser.add_argument("--scan-devices", type=int, nargs="*", default=[5, 7], help="addresses that answer a scan")
+    parser.add_argument("--log", action="store_true", help="keep writing the communication log")
+    parser.add_argument("--full", action="store_true", help="startup: run the real service until it advertises")
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark {name!r}")
+
+    if not args.log:
+        commLog.get_logger().level = commLog.OFF
+    handlerFunctions.SRQ_MODE = args.srq_mode
+    for name in args.benchmarks or BENCHMARKS:
+        BENCHMARKS[name](args)
+    print("phase latencies:")
+    print_phases()
+
+if __name__ == "__main__":
+    main()
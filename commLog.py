@@ -0,0 +1,106 @@
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+
+from batchWriter import BatchWriter
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+OFF = 100
+
+LOG_FILE = 'communication_log.txt'
+MAX_BYTES = 5 * 1024 * 1024  # Rotate once the file reaches this size
+MAX_AGE = 24 * 60 * 60       # ... or once it is this many seconds old
+BACKUP_COUNT = 5             # Compressed files kept after rotation
+FLUSH_INTERVAL = 0.5         # Seconds a record may sit in memory before it is written
+BATCH_SIZE = 256             # Records written per batch at most
+
+class CommLogger(BatchWriter):
+    """Queues log records in memory and writes them to disk in batches from a background thread.
+       The file is rotated by size and age, rotated files are gzip compressed, and anything still
+       queued is written out when the process exits."""
+    def __init__(self, path: str = LOG_FILE, level: int = INFO, echo: bool = True,
+                 maxBytes: int = MAX_BYTES, maxAge: float = MAX_AGE, backupCount: int = BACKUP_COUNT,
+                 flushInterval: float = FLUSH_INTERVAL):
+        self.path = path
+        self.level = level
+        self.echo = echo
+        self.maxBytes = maxBytes
+        self.maxAge = maxAge
+        self.backupCount = backupCount
+        self._file = None
+        self._opened = 0.0
+        BatchWriter.__init__(self, flushInterval, BATCH_SIZE)
+
+    def log(self, msg: str, level: int = INFO):
+        """Queues a record, this never touches the disk or the console on the caller's thread."""
+        if level < self.level or self._closed:
+            return
+        self.put(msg)
+
+    def _stop(self):
+        if self._file is not None:
+            self._file.close()
+
+    def _write(self, batch: list):
+        text = '\n'.join(batch) + '\n'
+        if self.echo:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        try:
+            if self._file is None:
+                self._open()
+            elif self._should_rotate():
+                self._rotate()
+            self._file.write(text)
+            self._file.flush()
+        except OSError as e:
+            print(f"Failed to write communication log: {e}")
+
+    def _open(self):
+        self._file = open(self.path, 'a')
+        self._opened = time.time()
+
+    def _should_rotate(self)->bool:
+        if self.maxBytes and self._file.tell() >= self.maxBytes:
+            return True
+        return bool(self.maxAge) and time.time() - self._opened >= self.maxAge
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        rotated = base = f"{self.path}.{time.strftime('%Y%m%d-%H%M%S')}"
+        index = 1
+        while os.path.exists(rotated + '.gz'):
+            rotated = f"{base}-{index}"
+            index += 1
+        os.replace(self.path, rotated)
+        with open(rotated, 'rb') as src, gzip.open(rotated + '.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+        self._prune()
+        self._open()
+
+    def _prune(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        prefix = os.path.basename(self.path) + '.'
+        backups = sorted((os.path.join(directory, name) for name in os.listdir(directory)
+                          if name.startswith(prefix) and name.endswith('.gz')), key=os.path.getmtime)
+        for path in backups[:max(0, len(backups) - self.backupCount)]:
+            os.remove(path)
+
+_logger = None
+_loggerLock = threading.Lock()
+
+def get_logger()->CommLogger:
+    """Returns the process-wide communication logger, starting it on first use."""
+    global _logger
+    with _loggerLock:
+        if _logger is None:
+            _logger = CommLogger()
+    return _logger
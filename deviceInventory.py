@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+
+from listDevicesUSB import list_usb_devices
+
+INVENTORY_TTL = 30.0  # Seconds a scan result stays fresh before the refresher rescans
+
+class DeviceInventory:
+    """Keeps the last GPIB device scan in memory and refreshes it from a background thread.
+       Readers only ever see a completed snapshot, so serving it never touches the bus."""
+    def __init__(self, ttl: float = INVENTORY_TTL, scanner=list_usb_devices):
+        self.ttl = ttl
+        self._scanner = scanner
+        self._devices = {}
+        self._payload = b'{}'
+        self._updated = 0.0
+        self._refresh_requested = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._startLock = threading.Lock()
+        self._listeners = []
+
+    def start(self):
+        """Starts the background refresher, which performs an initial scan right away. Does nothing once started."""
+        with self._startLock:
+            if self._thread is not None:
+                return
+            self._refresh_requested.set()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def started(self)->bool:
+        return self._thread is not None
+
+    def stop(self):
+        self._stop.set()
+        self._refresh_requested.set()
+
+    def refresh(self):
+        """Requests an immediate rescan without waiting for the TTL to expire."""
+        self._refresh_requested.set()
+
+    def add_listener(self, callback):
+        """Registers callback(devices) to be called from the refresher thread after every scan."""
+        self._listeners.append(callback)
+
+    def get_devices(self)->dict:
+        return self._devices
+
+    def get_payload(self)->bytes:
+        """Returns the last snapshot already encoded as UTF-8 JSON."""
+        return self._payload
+
+    def age(self)->float:
+        return time.monotonic() - self._updated
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._refresh_requested.wait(self.ttl)
+            self._refresh_requested.clear()
+            if self._stop.is_set():
+                break
+            self._scan()
+
+    def _scan(self):
+        try:
+            devices = self._scanner()
+        except Exception as e:
+            print(f"Device scan failed, keeping previous inventory: {e}")
+            return
+        # Swap in the new snapshot with single reference assignments
+        self._payload = json.dumps(devices).encode('utf-8')
+        self._devices = devices
+        self._updated = time.monotonic()
+        for callback in self._listeners:
+            try:
+                callback(devices)
+            except Exception as e:
+                print(f"Inventory listener failed: {e}")
@@ -0,0 +1,93 @@
+import collections
+import itertools
+import threading
+
+# Bus priorities, lower wins: the sort loop, then status queries, then background device scans
+SORT = 0
+STATUS = 1
+SCAN = 2
+
+class BusArbiter:
+    """Reentrant bus lock that hands the bus to the most urgent waiter.
+       Used directly (`with BUS_LOCK:`) it acquires at SORT priority; `with BUS_LOCK.priority(SCAN):` makes a
+       transaction wait while any higher priority thread is queued, so a device scan or status query never gets
+       between two sort transactions that are already waiting. Waiters of equal priority are served in arrival
+       order, and a transaction in progress is never interrupted."""
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._owner = None
+        self._depth = 0
+        self._queues = [collections.deque() for _ in (SORT, STATUS, SCAN)]
+        self._tickets = itertools.count()
+
+    def _blocked(self, priority: int, ticket: int)->bool:
+        return (self._owner is not None or any(self._queues[:priority])
+                or self._queues[priority][0] != ticket)
+
+    def acquire(self, priority: int = SORT):
+        me = threading.get_ident()
+        with self._cond:
+            if self._owner == me:
+                self._depth += 1
+                return
+            ticket = next(self._tickets)
+            queue = self._queues[priority]
+            queue.append(ticket)
+            try:
+                while self._blocked(priority, ticket):
+                    self._cond.wait()
+            except BaseException:
+                queue.remove(ticket)
+                self._cond.notify_all()  # Let whoever queued behind us go
+                raise
+            queue.remove(ticket)
+            self._owner = me
+            self._depth = 1
+
+    def release(self):
+        with self._cond:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("Bus released by a thread that does not hold it")
+            self._depth -= 1
+            if self._depth == 0:
+                self._owner = None
+                self._cond.notify_all()
+
+    def __enter__(self):
+        self.acquire(SORT)
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def priority(self, priority: int)->'_BusHold':
+        return _BusHold(self, priority)
+
+class _BusHold:
+    def __init__(self, arbiter: BusArbiter, priority: int):
+        self.arbiter = arbiter
+        self.priority = priority
+
+    def __enter__(self):
+        self.arbiter.acquire(self.priority)
+        return self.arbiter
+
+    def __exit__(self, *exc):
+        self.arbiter.release()
+
+# Serializes transactions from every thread that talks to the shared GPIB bus, so a command and
+# its response from one handler are never split by another handler's traffic or a device scan.
+BUS_LOCK = BusArbiter()
+
+_rm = None
+_rmLock = threading.Lock()
+
+def resource_manager():
+    """Process-wide pyvisa ResourceManager. pyvisa and its backend are imported on the first call,
+       so starting the service and advertising over BLE does not pay for them."""
+    global _rm
+    with _rmLock:
+        if _rm is None:
+            import pyvisa
+            _rm = pyvisa.ResourceManager()
+        return _rm
@@ -1,11 +1,109 @@
+import ctypes
+import ctypes.util
 import os
+import select
 import subprocess
+import threading
 import time
 
 # Optional: switch to root directory (if needed for your logic)
 # os.chdir("/")
 
-def configureDevice():
+GPIB_DEVICE = "/dev/gpib0"
+DEVICE_TIMEOUT = 10.0    # Seconds to wait for the device node after the udev trigger
+READY_TIMEOUT = 60.0     # Seconds a job waits for the board before failing
+STATE_FILE = "/run/rpi-sort/gpib-configured"  # tmpfs, so the cached state does not survive a reboot
+# USB GPIB adapters whose firmware is loaded by udev rules (NI, Agilent/Keysight)
+GPIB_USB_VENDORS = ("3923", "0957")
+
+# inotify constants from <sys/inotify.h>
+IN_CREATE = 0x100
+IN_ATTRIB = 0x004
+IN_MOVED_TO = 0x080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+GPIB_READY = threading.Event()
+_state = {"error": None, "thread": None}
+_readyListeners = []
+_lock = threading.Lock()
+
+def _device_signature(path: str = GPIB_DEVICE)->str:
+    """Identifies the current device node, it changes whenever the adapter is replugged or the module reloaded."""
+    st = os.stat(path)
+    return f"{st.st_rdev}:{st.st_ino}:{st.st_ctime_ns}"
+
+def is_configured(path: str = GPIB_DEVICE, stateFile: str = STATE_FILE)->bool:
+    """Cached state check: the device node exists and gpib_config already ran against this very node."""
+    try:
+        with open(stateFile) as f:
+            return f.read().strip() == _device_signature(path)
+    except OSError:
+        return False
+
+def _save_state(path: str = GPIB_DEVICE, stateFile: str = STATE_FILE):
+    try:
+        os.makedirs(os.path.dirname(stateFile), exist_ok=True)
+        with open(stateFile, 'w') as f:
+            f.write(_device_signature(path))
+    except OSError as e:
+        print(f"Could not record GPIB state: {e}")
+
+def _trigger_gpib():
+    """Replays udev add events for the gpib subsystem and the known USB adapters only, not every device."""
+    commands = [["udevadm", "trigger", "--action=add", "--subsystem-match=gpib"]]
+    commands += [["udevadm", "trigger", "--action=add", "--subsystem-match=usb", f"--attr-match=idVendor={vendor}"]
+                 for vendor in GPIB_USB_VENDORS]
+    for command in commands:
+        subprocess.run(command, check=True)
+
+def _inotify_init():
+    """Returns an inotify file descriptor from libc, or None where it is unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        return (libc, fd) if fd >= 0 else None
+    except (OSError, AttributeError):
+        return None
+
+def wait_for_device(path: str = GPIB_DEVICE, timeout: float = DEVICE_TIMEOUT)->bool:
+    """Waits for the device node to appear, woken by inotify on its directory instead of sleeping.
+       Falls back to a short polling interval if inotify cannot be used."""
+    deadline = time.monotonic() + timeout
+    inotify = _inotify_init()
+    if inotify is None:
+        while not os.path.exists(path):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    libc, fd = inotify
+    try:
+        # Watch before checking so a node created in between is not missed
+        libc.inotify_add_watch(fd, os.path.dirname(path).encode(), IN_CREATE | IN_ATTRIB | IN_MOVED_TO)
+        while not os.path.exists(path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if readable:
+                try:
+                    os.read(fd, 4096)  # Drain, the events themselves are not needed
+                except BlockingIOError:
+                    pass
+        return True
+    finally:
+        os.close(fd)
+
+def configureDevice(force: bool = False)->bool:
+    """Brings the GPIB board up if needed and returns True once it is usable.
+       Idempotent: when the board is already configured nothing is run, otherwise the udev rules are
+       reloaded, only the gpib devices are triggered, the node is awaited and gpib_config is run."""
+    if not force and is_configured():
+        print(f"{GPIB_DEVICE} already configured")
+        return True
+
     # Step 1: Reload udev rules
     try:
         subprocess.run(["udevadm", "control", "--reload"], check=True)
@@ -13,21 +111,18 @@ def configureDevice():
     except Exception as e:
         print("udev reload failed:", e)
 
-    # Step 2: Trigger udev (simulate replugging all devices)
-    try:
-        subprocess.run(["udevadm", "trigger"], check=True)
-        print("udev trigger executed")
-    except Exception as e:
-        print("udev trigger failed:", e)
+    # Step 2: Trigger udev for the GPIB adapter only
+    if not os.path.exists(GPIB_DEVICE) or force:
+        try:
+            _trigger_gpib()
+            print("udev trigger executed")
+        except Exception as e:
+            print("udev trigger failed:", e)
 
     # Step 3: Wait for /dev/gpib0 to appear
-    for i in range(10):
-        if os.path.exists("/dev/gpib0"):
-            print("/dev/gpib0 is now available")
-            break
-        time.sleep(1)
-    else:
+    if not wait_for_device():
         raise RuntimeError("GPIB device did not appear")
+    print(f"{GPIB_DEVICE} is now available")
 
     # Step 4: Run gpib_config (adjust path if needed)
     try:
@@ -35,6 +130,59 @@ def configureDevice():
         print("gpib_config executed successfully")
     except Exception as e:
         print("gpib_config failed:", e)
-        
+        return False
+    _save_state()
+    return True
+
+def add_ready_listener(callback):
+    """Calls callback() once the board is configured, right away if it already is."""
+    with _lock:
+        if not GPIB_READY.is_set() or _state["error"] is not None:
+            _readyListeners.append(callback)
+            return
+    callback()
+
+def _configure_worker():
+    error = None
+    try:
+        if not configureDevice():
+            error = "gpib_config failed"
+    except Exception as e:
+        print(f"GPIB configuration failed: {e}")
+        error = str(e)
+    with _lock:
+        _state["error"] = error
+        GPIB_READY.set()  # Also set on failure so waiting jobs fail fast instead of timing out
+        if error is not None:
+            return  # Listeners stay registered for the next attempt
+        listeners = list(_readyListeners)
+        _readyListeners.clear()
+    for callback in listeners:
+        try:
+            callback()
+        except Exception as e:
+            print(f"GPIB ready listener failed: {e}")
+
+def configure_in_background()->threading.Thread:
+    """Starts the configuration on a daemon thread. Runs once per process while it succeeds; after a failed
+       attempt the next call resets the ready state and tries again, so a replugged adapter is picked up."""
+    with _lock:
+        thread = _state["thread"]
+        if thread is None or (not thread.is_alive() and _state["error"] is not None):
+            GPIB_READY.clear()
+            _state["error"] = None
+            thread = _state["thread"] = threading.Thread(target=_configure_worker, daemon=True)
+            thread.start()
+        return thread
+
+def wait_until_ready(timeout: float = READY_TIMEOUT):
+    """GPIB ready gate for the job path, raises RuntimeError if the board is not usable.
+       Starts a new configuration attempt if the last one failed."""
+    configure_in_background()
+    if not GPIB_READY.wait(timeout):
+        raise RuntimeError("Timed out waiting for GPIB configuration")
+    if _state["error"] is not None:
+        raise RuntimeError(f"GPIB not configured: {_state['error']}")
+
 if __name__ == "__main__":
-    configureDevice()
\ No newline at end of file
+    configureDevice(force=True)
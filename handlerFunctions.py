@@ -1,39 +1,91 @@
-import pyvisa
-import pandas as pd
-import time
+from typing import TYPE_CHECKING
+
+import metrics
+from metrics import now_ns
+from srq import srq_waiter, attach_dispatcher
+from gpibBus import BUS_LOCK
+from sessionPool import SessionPool, get_pool
+from commLog import get_logger
+from idIndex import IDIndex, VersionedIDSet
+from idLoader import load_ids
+
+if TYPE_CHECKING:
+    import pyvisa  # Loaded on first use, see gpibBus.resource_manager()
+
+SRQ_MODE = "auto"      # "event", "ibwait", "poll" or "auto"
+CHECKEMPTY_TIMEOUT = None  # Seconds to wait for the empty socket check SRQ, None waits forever
+PART_TIMEOUT = None        # Seconds to wait for a part SRQ, None waits forever
+
+# Per-phase timings of the sort cycle, see metrics.py
+SRQ_WAIT_TIME = metrics.histogram("srq_wait", "Waiting for the part SRQ")
+QRC_TIME = metrics.histogram("qrc", "FULLSITES? and QRC? exchanges")
+DECISION_TIME = metrics.histogram("decision", "Bin decision including PAUSE/RESUME")
+BINON_TIME = metrics.histogram("binon", "BINON, its response and ECHOOK")
+CYCLE_TIME = metrics.histogram("cycle", "Whole sort cycle")
+LOG_TIME = metrics.histogram("log", "Queueing a communication log record")
+CONFIGURE_TIME = metrics.histogram("configure", "Handler configuration and empty socket check")
+PARTS_SORTED = metrics.counter("parts", "Parts sorted")
+PARTS_PASSED = metrics.counter("parts_passed", "Parts sorted to the pass bin")
 
 def write_log(msg: str) -> None:
-    """Function that writes a message to the log file."""
-    with open('communication_log.txt', 'a') as log_file:
-        log_file.write(msg + '\n')
+    """Function that queues a message for the log file and console, the write happens on a background thread."""
+    start = now_ns()
+    get_logger().log(msg)
+    LOG_TIME.since(start)
 
-def write(instrument: pyvisa.Resource, msg: str)->None:
+def write(instrument: 'pyvisa.Resource', msg: str)->None:
     """Function that sends a command and automatically logs it to the console."""
-    instrument.write(msg)
-    logmsg = f"-> {msg}"
-    print(logmsg)
-    write_log(logmsg)
+    with BUS_LOCK:
+        instrument.write(msg)
+    write_log(f"-> {msg}")
     
-def read(instrument: pyvisa.Resource)->str:
+def read(instrument: 'pyvisa.Resource')->str:
     """Function that reads a command and automatically logs it to the console."""
-    msg = instrument.read()
-    logmsg = f"<- {msg}"
-    print(logmsg)
-    write_log(logmsg)
+    with BUS_LOCK:
+        msg = instrument.read()
+    write_log(f"<- {msg}")
     return msg
 
-def configure(GPIBaddr: str)->pyvisa.Resource:
-    """Configures the machine to be run, given the handler IDN and GPIB address. 
-        It then connects to the handler, runs the confiugration commands, and returns the pyVISA resource for use in other methods."""
-    rm = pyvisa.ResourceManager()
-    print(rm.list_resources()) # List all connected instruments
+# The handler exchanges are written once as generators of steps: each yields (WRITE, msg), (READ,) or
+# (WAIT_SRQ, status, timeout) and receives the response, the status byte or None back. runSteps() drives them
+# on a pyvisa resource, transport.Transport.run() on any asynchronous transport.
+WRITE = "write"
+READ = "read"
+WAIT_SRQ = "wait_srq"
+CONFIGURE_COMMANDS = ("CONFIGURE,SRQ=Y", "CONFIGURE,FULLSITES?=Y", "CONFIGURE,CONTACTOR=Y")
 
-    # Replace with your actual GPIB address
-    inst = rm.open_resource(GPIBaddr)
+def runSteps(instrument: 'pyvisa.Resource', steps, stopEvent=None):
+    """Runs protocol steps against a pyvisa resource and returns the generator's return value.
+       SRQ waits return None to the steps as soon as stopEvent is set."""
+    result = None
+    try:
+        while True:
+            step = steps.send(result)
+            if step[0] == WRITE:
+                write(instrument, step[1])
+                result = None
+            elif step[0] == READ:
+                result = read(instrument)
+            else:
+                result = srq_waiter(instrument, SRQ_MODE).wait(step[1], timeout=step[2], stopEvent=stopEvent)
+    except StopIteration as stop:
+        return stop.value
+
+def configure(GPIBaddr: str, srqDispatcher=None, rm=None, stopEvent=None)->'pyvisa.Resource':
+    """Configures the machine to be run, given the handler IDN and GPIB address. 
+        It then connects to the handler, runs the confiugration commands, and returns the pyVISA resource for use in other methods.
+        Pass the SrqDispatcher so service requests are routed by serial poll once several handlers share the bus.
+        The session comes from the process-wide pool and stays open for the next job; the benchmark passes a simulated rm.
+        Setting stopEvent cuts the empty socket check short, the handler is then returned unconfigured."""
+    start = now_ns()
+    pool = get_pool() if rm is None else SessionPool(rm)
+    inst = pool.lease(GPIBaddr)
     
     # Set termination characters
     inst.write_termination = '\r\n' # This appends <CR><LF> to every write
     inst.read_termination = '\r\n'  # This expects <CR><LF> at the end of responses
+    if srqDispatcher is not None:
+        attach_dispatcher(inst, GPIBaddr, srqDispatcher, SRQ_MODE)
 
     # Confirm correct device is connected
     # handlerIDN='SYNAX, S9, ID:ABCD9999, s/n:99999, MPC:1.00.0 / MCC:1.00.0'
@@ -42,109 +94,216 @@ def configure(GPIBaddr: str)->pyvisa.Resource:
     # assert response == handlerIDN, f"Received Handler IDN:\t{response}\ndoes not match provided IDN:\t{handlerIDN}" 
     
     # Begin Configuration Commands
-    write(inst, "CONFIGURE,SRQ=Y")
-    response = read(inst)
-    assert response == 'CONFIGURE,SRQ=Y:OK',f"Expected \''CONFIGURE,SRQ=Y:OK\' but received\'{response}\'"
+    runSteps(inst, configureSteps(), stopEvent)
+    CONFIGURE_TIME.since(start)
     
-    write(inst, "CONFIGURE,FULLSITES?=Y")
-    response = read(inst)
-    assert response == 'CONFIGURE,FULLSITES?=Y:OK',f"Expected \''CONFIGURE,FULLSITES?=Y:OK\' but received\'{response}\'"
-    
-    write(inst, "CONFIGURE,CONTACTOR=Y")
-    response = read(inst)
-    assert response == 'CONFIGURE,CONTACTOR=Y:OK',f"Expected \''CONFIGURE,CONTACTOR=Y:OK\' but received\'{response}\'"
+    return inst  
+
+def configureSteps():
+    """Configuration commands, 2DID readability and empty socket check, as protocol steps.
+       Returns False if a stop was requested during the empty socket check."""
+    for command in CONFIGURE_COMMANDS:
+        yield WRITE, command
+        response = yield READ,
+        assert response == f"{command}:OK", f"Expected \'{command}:OK\' but received \'{response}\'"
     
     # Confirm 2DID Readability
-    write(inst, "QRM?")
-    response = read(inst)
-    assert response == 'QRM:1', f"Expected \'QRM:!\' but received \'{response}\'"
+    yield WRITE, "QRM?"
+    response = yield READ,
+    assert response == 'QRM:1', f"Expected \'QRM:1\' but received \'{response}\'"
     
     # Empty socket check
-    write(inst, "REQUEST,CHECKEMPTY")
+    yield WRITE, "REQUEST,CHECKEMPTY"
     print("Waiting for SRQ...")
-    while True:
-        status = inst.read_stb()
-        if status & 0x40:  # SRQ asserted
-            if status == 0x44:
-                print("SRQ44 (Empty Socket Check) received.")
-                break
-            else:
-                print(f"SRQ asserted, but not ESC (status byte = {hex(status)}). Waiting...")
-        time.sleep(0.1)
+    if (yield WAIT_SRQ, 0x44, CHECKEMPTY_TIMEOUT) is None:
+        print("Stop requested during the empty socket check.")
+        return False
+    print("SRQ44 (Empty Socket Check) received.")
     print("SRQ asserted. Reading CHECKEMPTY message...")
-    response = read(inst)
+    response = yield READ,
     assert response == 'CHECKEMPTY', f"Expected \'CHECKEMPTY\' but received \'{response}\'"
-    write(inst, "ECHOOK")
-    
-    return inst  
+    yield WRITE, "ECHOOK"
+    return True
 
-def lotFinished(instrument: pyvisa.Resource)->bool:
+def lotFinished(instrument: 'pyvisa.Resource')->bool:
     """Checks if the the current lot is finished by sending SRQKIND? query."""
-    write(instrument, "SRQKIND?")
-    response = read(instrument)
+    return runSteps(instrument, lotFinishedSteps())
+
+def lotFinishedSteps():
+    """SRQKIND? query as protocol steps, returns True once the handler reports the end of the lot."""
+    yield WRITE, "SRQKIND?"
+    response = yield READ,
     if (response == "SRQKIND 2"): return False
     elif (response == "SRQKIND 8"): return True
     else:
         print(f"Error: Unexpected Response: {response}")
         return True
 
-def sortCycle(instrument: pyvisa.Resource, IDset: set, passBin=1, failBin=2)->bool:
-    """Runs through the commands for sorting one chip, given the set of accepted 2DIDs."""
-    print("Waiting for SRQ...")
+class HandlerProfile:
+    """Options for how a sort cycle talks to a particular handler.
+       queryFullsites sends the FULLSITES? query before QRC?, pauseForDecision wraps the bin decision in PAUSE/RESUME,
+       multiSite bins every occupied site per SRQ, and verbose prints every step of the cycle to the console."""
+    def __init__(self, name: str, queryFullsites: bool = True, pauseForDecision: bool = True, verbose: bool = True,
+                 multiSite: bool = False):
+        self.name = name
+        self.queryFullsites = queryFullsites or multiSite  # The site bitmap is needed to sort several sites
+        self.pauseForDecision = pauseForDecision
+        self.verbose = verbose
+        self.multiSite = multiSite
+
+HANDLER_PROFILES = {
+    # Every transaction of the original cycle
+    "standard": HandlerProfile("standard"),
+    # Skips the unused FULLSITES? answer and the PAUSE/RESUME around an in-memory lookup
+    "fast": HandlerProfile("fast", queryFullsites=False, pauseForDecision=False, verbose=False),
+    # Decides every occupied site from one FULLSITES?/QRC? pair and bins them with a single BINON
+    "multisite": HandlerProfile("multisite", pauseForDecision=False, verbose=False, multiSite=True),
+}
+MAX_SITES = 32  # BINON carries one hex digit per site in four groups of eight
+DEFAULT_PROFILE = "standard"
+
+def getProfile(profile)->HandlerProfile:
+    """Accepts a profile name or a HandlerProfile."""
+    if isinstance(profile, HandlerProfile):
+        return profile
+    return HANDLER_PROFILES[profile or DEFAULT_PROFILE]
+
+def parseQRC(response: str)->str:
+    """Returns the first 2DID of a 'QRC:<id>,...' response with a single slice."""
+    start = response.find(':') + 1
+    end = response.find(',', start)
+    return response[start:end] if end >= 0 else response[start:]
+
+def parseFullsites(response: str)->int:
+    """Returns the occupied site bitmap of a FULLSITES response, bit 0 being site 1.
+       The hex digits are read right to left like BINON, with or without the comma separated groups."""
+    start = max(response.find(':'), response.find(' ')) + 1
+    digits = response[start:].replace(',', '').strip()
+    return int(digits, 16) if digits else 0
+
+def parseQRCSites(response: str, sites: int)->dict:
+    """Maps each occupied site of the bitmap to its 2DID from a 'QRC:<id1>,<id2>,...' response.
+       When the handler lists a field up to the highest occupied site the fields are matched by position,
+       when it lists exactly one field per occupied site they are matched in order. An unreadable 2DID stays
+       empty for its own site, so it is failed instead of taking a neighbour's ID; a response that fits
+       neither layout leaves every site empty."""
+    fields = [field.strip() for field in response[response.find(':') + 1:].split(',')]
+    if len(fields) > 1 and not fields[-1]:
+        fields.pop()  # Trailing comma
+    occupied = [site for site in range(1, MAX_SITES + 1) if sites & (1 << (site - 1))]
+    if not occupied:
+        return {}
+    if len(fields) >= occupied[-1]:
+        return {site: fields[site - 1] for site in occupied}
+    if len(fields) == len(occupied):
+        return dict(zip(occupied, fields))
+    print(f"Error: QRC response '{response}' does not match the occupied sites {occupied}")
+    return {site: '' for site in occupied}
+
+def formatBINON(bins: dict)->str:
+    """Builds a BINON command from {site: bin}, site 1 being the rightmost digit."""
+    digits = ['0'] * MAX_SITES
+    for site, bin in bins.items():
+        digits[MAX_SITES - site] = format(bin, 'X')
+    text = ''.join(digits)
+    return "BINON:" + ','.join(text[i:i + 8] for i in range(0, MAX_SITES, 8))
+
+def sortCycleSteps(IDset: set, passBin=1, failBin=2, onResult=None, profile=DEFAULT_PROFILE):
+    """Protocol steps of one handler index, returning the bins in site order, or an empty list if the lot
+       ended (SRQ 0x48) or a stop was requested before a part arrived.
+       Single-site profiles read the one 2DID from QRC?; multi-site profiles read the FULLSITES? bitmap and all
+       2DIDs, decide them in one batch and bin them all with a single BINON.
+       onResult(ID, bin, cycleTime, site) is called for every part once it has been binned."""
+    profile = getProfile(profile)
+    verbose = profile.verbose
+    start = t = now_ns()
+    if verbose: print("Waiting for SRQ...")
     while True:
-        status = instrument.read_stb()
-        if status & 0x40:  # SRQ asserted
-            if status == 0x41:
-                print("SRQ41 received.")
-                break
-            else:
-                print(f"SRQ asserted, but not ESC (status byte = {hex(status)}). Waiting...")
-        time.sleep(0.1)
-    print("SRQ asserted. Sending FULLSITES? message...")
+        status = yield WAIT_SRQ, (0x41, 0x48), PART_TIMEOUT
+        if status is None:
+            print("Stop requested while waiting for a part.")
+            return []
+        if status == 0x41:
+            break
+        if (yield from lotFinishedSteps()):
+            print("Handler reported the end of the lot.")
+            return []
+    if verbose: print("SRQ41 received.")
+    t = SRQ_WAIT_TIME.since(t)
     
-    write(instrument, "FULLSITES?")
-    response = read(instrument)
+    sites = 1
+    if profile.queryFullsites:
+        if verbose: print("SRQ asserted. Sending FULLSITES? message...")
+        yield WRITE, "FULLSITES?"
+        response = yield READ,
+        if profile.multiSite:
+            sites = parseFullsites(response)
     
-    write(instrument, "QRC?")
-    response = read(instrument)
-    ID = response[response.find(':')+1:response.find(',')]
+    yield WRITE, "QRC?"
+    response = yield READ,
+    IDs = parseQRCSites(response, sites) if profile.multiSite else {1: parseQRC(response)}
+    t = QRC_TIME.since(t)
     
-    write(instrument, "PAUSE")
-    bin = getBinNumber(ID=ID, IDset=IDset)  # Wait for bin decision
-    write(instrument, "RESUME")
+    if profile.pauseForDecision: yield WRITE, "PAUSE"
+    bins = {site: getBinNumber(ID=ID, IDset=IDset, passBin=passBin, failBin=failBin, verbose=verbose)
+            for site, ID in IDs.items()}  # Wait for bin decision
+    if profile.pauseForDecision: yield WRITE, "RESUME"
+    t = DECISION_TIME.since(t)
     
-    write(instrument, f"BINON:00000000,00000000,00000000,0000000{bin}")
-    
-    read(instrument)  # Read the response to BINON command
-    write(instrument, "ECHOOK")
+    yield WRITE, formatBINON(bins)
+    yield READ,  # Read the response to BINON command
+    yield WRITE, "ECHOOK"
+    end = BINON_TIME.since(t)
+    CYCLE_TIME.observe_ns(end - start)
+    PARTS_SORTED.inc(len(bins))
+    PARTS_PASSED.inc(sum(1 for bin in bins.values() if bin == passBin))
+    if onResult is not None:
+        cycleTime = (end - start) / 1e9
+        for site, ID in IDs.items():
+            onResult(ID, bins[site], cycleTime, site)
+    return [bins[site] for site in sorted(bins)]
+
+def sortCycleMultiSite(instrument: 'pyvisa.Resource', IDset: set, passBin=1, failBin=2, onResult=None, profile="multisite",
+                       stopEvent=None)->list:
+    """Sorts every occupied site of one handler index with a multi-site profile. Returns the bins in site order,
+       empty once the lot has ended or stopEvent was set while waiting for the part."""
+    return runSteps(instrument, sortCycleSteps(IDset, passBin, failBin, onResult, profile), stopEvent)
+
+def sortCycle(instrument: 'pyvisa.Resource', IDset: set, passBin=1, failBin=2, onResult=None, profile=DEFAULT_PROFILE,
+              stopEvent=None)->int:
+    """Runs through the commands for sorting one chip, given the set of accepted 2DIDs. Returns the bin the chip was sent to,
+       or None once the lot has ended or stopEvent was set while waiting for the chip.
+       onResult(ID, bin, cycleTime, site) is called once the chip has been binned."""
+    bins = runSteps(instrument, sortCycleSteps(IDset, passBin, failBin, onResult, profile), stopEvent)
+    return bins[0] if bins else None
      
-def getBinNumber(ID: str, IDset: set, passBin=1, failBin=2, manual=False)->int:
+def getBinNumber(ID: str, IDset: set, passBin=1, failBin=2, manual=False, verbose=True)->int:
     """Returns the bin number based on the 2DID. 
        If the ID is in the set of accepted IDs, it returns passBin, otherwise it returns failBin."""
-    print(f"Processing ID: {ID}")
+    if verbose: print(f"Processing ID: {ID}")
     if manual:
         bin = input(f"Enter bin number for ID {ID} (1 for pass, 2 for fail): ")
         return int(bin) if bin.isdigit() and int(bin) in (passBin, failBin) else failBin
-    if ID in IDset: 
-        print(f"ID {ID} in set. Sorting to pass bin {passBin}.")
+    if ID and ID in IDset: 
+        if verbose: print(f"ID {ID} in set. Sorting to pass bin {passBin}.")
         return passBin
     else:
-        print(f"ID {ID} not in set. Sorting to fail bin.")
+        if verbose: print(f"ID {ID} not in set. Sorting to fail bin.")
         return failBin
         
-def collect2DIDs(excelFileDir: str, sheetName: str, columnIndex=0)->set:
-    """Accepts Excel workbook, and grabs all the IDs from the given column and given sheet, starting on the second row."""
+def collect2DIDs(excelFileDir: str, sheetName, columnIndex=0)->IDIndex:
+    """Accepts an Excel workbook, CSV or text file, and grabs all the IDs from the given column and given sheet, starting on the second row.
+       Only the requested column is streamed, and the result is cached so reopening the same file is nearly instant."""
     try:
-        df = pd.read_excel(excelFileDir, sheet_name=sheetName)
-        
         # Validate column index
-        if isinstance(columnIndex, int) and 0 <= columnIndex < len(df.columns):
-            column_values = df.iloc[:, columnIndex].dropna().tolist()
-            #column_values = column_values[1:] # Skip header or first row
-            return set(column_values)
+        if isinstance(columnIndex, int):
+            return load_ids(excelFileDir, sheetName, columnIndex)
         else:
             print(f"Error: Column index '{columnIndex}' is out of range.")
             return None
+    except IndexError as e:
+        print(f"Error: {e}")
+        return None
     except FileNotFoundError:
         print(f"Error: File '{excelFileDir}' not found.")
         return None
@@ -152,17 +311,51 @@ def collect2DIDs(excelFileDir: str, sheetName: str, columnIndex=0)->set:
         print(f"An error occurred: {e}")
         return None
     
-def main(GPIBaddr: str, numParts: int = 30000, IDset: set = None):
-    inst = configure(GPIBaddr)
-    
+def main(GPIBaddr: str, numParts: int = 30000, IDset: set = None, progress=None, stopEvent=None, onResult=None,
+         profile=DEFAULT_PROFILE, srqDispatcher=None):
+    """Configures the handler and sorts up to numParts chips using the given handler profile.
+       progress(bin) is called after every part, onResult is passed on to sortCycle, and the lot stops early once stopEvent is set."""
+    profile = getProfile(profile)
+    try:
+        inst = configure(GPIBaddr, srqDispatcher, stopEvent=stopEvent)
+        if stopEvent is not None and stopEvent.is_set():
+            # Stopped during the empty socket check, its reply is still pending
+            with BUS_LOCK:
+                inst.clear()
+            get_pool().discard(GPIBaddr)
+            return
+        runLot(inst, numParts, IDset, progress, stopEvent, onResult, profile)
+    except Exception:
+        get_pool().discard(GPIBaddr)  # The session may be mid-transaction, open a fresh one next time
+        raise
+    finally:
+        get_pool().release(GPIBaddr)
+        if srqDispatcher is not None:
+            srqDispatcher.unregister(GPIBaddr)
+
+def runLot(inst: 'pyvisa.Resource', numParts: int, IDset, progress, stopEvent, onResult, profile: HandlerProfile):
+    """Sort loop of main() on an already configured handler. Ends after numParts parts, when the handler reports
+       the end of the lot, or as soon as stopEvent is set, even while waiting for a part."""
     print(f"Starting sort cycle with {numParts} parts and ID set: {IDset}")
     if IDset is None:
         print("No ID set provided. Using empty set.")
         IDset = set()
     
-    for i in range(numParts):
-        print(f"Processing part {i+1}/{numParts}")
-        sortCycle(inst, IDset=IDset, passBin=1, failBin=2)
+    partsDone = 0
+    while partsDone < numParts:
+        if stopEvent is not None and stopEvent.is_set():
+            print(f"Stop requested after {partsDone} parts.")
+            break
+        if profile.verbose: print(f"Processing part {partsDone+1}/{numParts}")
+        # ID deltas sent during the lot take effect here, between cycles
+        cycleIDs = IDset.snapshot() if isinstance(IDset, VersionedIDSet) else IDset
+        bins = runSteps(inst, sortCycleSteps(cycleIDs, passBin=1, failBin=2, onResult=onResult, profile=profile), stopEvent)
+        if not bins:
+            break  # End of the lot, or stopped while waiting for a part
+        partsDone += len(bins)
+        if progress is not None:
+            for bin in bins:
+                progress(bin)
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
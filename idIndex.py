@@ -0,0 +1,200 @@
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+MAGIC = b'RPIIDX02'  # 02: IDs are no longer upper-cased, older caches are rebuilt
+HEADER = struct.Struct('<8sIIIII')  # magic, count, width, slots, bloom bits, bloom hashes
+ID_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'rpi-sort', 'ids')
+BLOOM_BITS_PER_ID = 10
+BLOOM_HASHES = 4
+
+def normalize_id(value)->str:
+    """Returns the canonical form of a 2DID so uploads, spreadsheets and handler reads compare equal.
+       Only surrounding whitespace and spreadsheet float formatting are normalized, matching stays case-sensitive."""
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)  # Spreadsheet cells come back as 12345.0
+    return str(value).strip()
+
+def _bloom_positions(key: bytes, bits: int, hashes: int):
+    h1 = zlib.crc32(key)
+    h2 = zlib.adler32(key) | 1
+    return [(h1 + i * h2) % bits for i in range(hashes)]
+
+class IDIndex:
+    """Read-only set of accepted 2DIDs compiled into a packed open-addressing hash table.
+       IDs are stored as fixed-width NUL padded bytes, so the table is a single buffer that can be
+       memory-mapped straight from disk. Lookups hash once and probe a slot or two, independent of the
+       number of IDs. An optional bloom filter in front rejects most unknown IDs without touching the table."""
+    def __init__(self, buffer):
+        magic, self.count, self.width, self.slots, self.bloomBits, self.bloomHashes = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a compiled ID index")
+        self._buffer = buffer
+        self._mask = self.slots - 1
+        self._table = memoryview(buffer)[HEADER.size:HEADER.size + self.slots * self.width]
+        bloomStart = HEADER.size + self.slots * self.width
+        self._bloom = memoryview(buffer)[bloomStart:bloomStart + self.bloomBits // 8] if self.bloomBits else None
+
+    @classmethod
+    def build(cls, ids, bloom: bool = False)->'IDIndex':
+        """Compiles an iterable of IDs into an in-memory index."""
+        return cls(cls.compile(ids, bloom))
+
+    @staticmethod
+    def compile(ids, bloom: bool = False)->bytearray:
+        """Returns the serialized index for an iterable of IDs."""
+        keys = {normalize_id(i).encode('utf-8') for i in ids}
+        keys.discard(b'')
+        width = max((len(k) for k in keys), default=1)
+        slots = 1
+        while slots < 2 * len(keys):  # Keep the load factor at or below 1/2
+            slots <<= 1
+        bloomBits = 0
+        if bloom and keys:
+            bloomBits = (len(keys) * BLOOM_BITS_PER_ID + 7) // 8 * 8
+        hashes = BLOOM_HASHES if bloomBits else 0
+
+        buffer = bytearray(HEADER.size + slots * width + bloomBits // 8)
+        HEADER.pack_into(buffer, 0, MAGIC, len(keys), width, slots, bloomBits, hashes)
+        table = HEADER.size
+        mask = slots - 1
+        for key in keys:
+            i = zlib.crc32(key) & mask
+            while buffer[table + i * width]:
+                i = (i + 1) & mask
+            buffer[table + i * width:table + i * width + len(key)] = key
+        if bloomBits:
+            start = table + slots * width
+            for key in keys:
+                for bit in _bloom_positions(key, bloomBits, hashes):
+                    buffer[start + (bit >> 3)] |= 1 << (bit & 7)
+        return buffer
+
+    @classmethod
+    def load(cls, path: str)->'IDIndex':
+        """Memory-maps a compiled index file, pages are only read as lookups touch them."""
+        with open(path, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer)
+
+    def save(self, path: str):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self._buffer)
+        os.replace(tmp, path)
+
+    def __contains__(self, value)->bool:
+        key = normalize_id(value).encode('utf-8')
+        width = self.width
+        if not key or len(key) > width:
+            return False
+        if self._bloom is not None:
+            for bit in _bloom_positions(key, self.bloomBits, self.bloomHashes):
+                if not self._bloom[bit >> 3] & (1 << (bit & 7)):
+                    return False
+        padded = key.ljust(width, b'\0')
+        table = self._table
+        mask = self._mask
+        i = zlib.crc32(key) & mask
+        while True:
+            slot = table[i * width:(i + 1) * width]
+            if slot == padded:
+                return True
+            if not slot[0]:
+                return False
+            i = (i + 1) & mask
+
+    def __len__(self)->int:
+        return self.count
+
+    def __iter__(self):
+        width = self.width
+        for i in range(self.slots):
+            slot = bytes(self._table[i * width:(i + 1) * width])
+            if slot[0]:
+                yield slot.rstrip(b'\0').decode('utf-8')
+
+    def __repr__(self)->str:
+        return f"IDIndex({self.count} IDs)"
+
+def ids_digest(ids)->str:
+    """Order-independent digest of an ID list, used as its cache key."""
+    keys = sorted({normalize_id(i) for i in ids})
+    return hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+
+def compile_ids(ids, cacheDir: str = ID_CACHE_DIR, bloom: bool = False)->IDIndex:
+    """Returns a memory-mapped index for an ID list, compiling it only the first time the list is seen."""
+    if isinstance(ids, IDIndex):
+        return ids
+    ids = list(ids)
+    path = os.path.join(cacheDir, f"{ids_digest(ids)}{'-bloom' if bloom else ''}.idx")
+    if os.path.exists(path):
+        try:
+            return IDIndex.load(path)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable ID cache {path}: {e}")
+    os.makedirs(cacheDir, exist_ok=True)
+    IDIndex.build(ids, bloom).save(path)
+    return IDIndex.load(path)
+
+class IDSnapshot:
+    """Immutable view of an ID set: a base index plus the IDs added and removed since it was compiled."""
+    __slots__ = ('base', 'added', 'removed', 'version', 'count')
+
+    def __init__(self, base, added: frozenset = frozenset(), removed: frozenset = frozenset(), version: int = 0):
+        self.base = base
+        self.added = added
+        self.removed = removed
+        self.version = version
+        self.count = (len(base) + sum(1 for ID in added if ID not in base)
+                      - sum(1 for ID in removed if ID in base))
+
+    def __contains__(self, value)->bool:
+        key = normalize_id(value)
+        if key in self.removed:
+            return False
+        return key in self.added or key in self.base
+
+    def __len__(self)->int:
+        return self.count
+
+    def __repr__(self)->str:
+        return f"IDSnapshot(v{self.version}, {self.count} IDs, +{len(self.added)} -{len(self.removed)})"
+
+class VersionedIDSet:
+    """Accepted-ID set of a running job that can be changed without stopping it.
+       Deltas build a new IDSnapshot and swap it in with one reference assignment, so lookups never take a lock;
+       the sort loop takes one snapshot per cycle, which keeps every site of an index on the same version."""
+    def __init__(self, base):
+        self._snapshot = IDSnapshot(base)
+        self._lock = threading.Lock()  # Serializes writers only
+
+    def snapshot(self)->IDSnapshot:
+        return self._snapshot
+
+    @property
+    def version(self)->int:
+        return self._snapshot.version
+
+    def apply(self, add=(), remove=())->int:
+        """Adds and removes IDs atomically and returns the new version. An ID in both lists ends up removed."""
+        add = frozenset(normalize_id(ID) for ID in add)
+        remove = frozenset(normalize_id(ID) for ID in remove)
+        with self._lock:
+            old = self._snapshot
+            added = (old.added - remove) | (add - remove)
+            removed = (old.removed - add) | remove
+            self._snapshot = IDSnapshot(old.base, added, removed, old.version + 1)
+            return self._snapshot.version
+
+    def __contains__(self, value)->bool:
+        return value in self._snapshot
+
+    def __len__(self)->int:
+        return len(self._snapshot)
+
+    def __repr__(self)->str:
+        return repr(self._snapshot)
@@ -0,0 +1,104 @@
+import csv
+import hashlib
+import os
+
+from idIndex import IDIndex, ID_CACHE_DIR
+
+LOT_CACHE_DIR = os.path.join(ID_CACHE_DIR, 'lots')
+CHUNK_SIZE = 1024 * 1024
+
+def file_digest(path: str)->str:
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def iter_excel(path: str, sheetName, columnIndex: int, headerRows: int = 1):
+    """Streams one column of a worksheet row by row without loading the workbook into memory."""
+    from openpyxl import load_workbook
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb.worksheets[sheetName] if isinstance(sheetName, int) else wb[sheetName]
+        for (value,) in ws.iter_rows(min_row=headerRows + 1, min_col=columnIndex + 1,
+                                     max_col=columnIndex + 1, values_only=True):
+            yield value
+    finally:
+        wb.close()
+
+def iter_xls(path: str, sheetName, columnIndex: int, headerRows: int = 1):
+    """Legacy .xls workbooks are not supported by openpyxl, so they still go through pandas."""
+    import pandas as pd
+    df = pd.read_excel(path, sheet_name=sheetName, header=None, skiprows=headerRows, usecols=[columnIndex])
+    yield from df.iloc[:, 0].tolist()
+
+def csv_delimiter(path: str)->str:
+    return '\t' if os.path.splitext(path)[1].lower() == '.tsv' else ','
+
+def iter_csv(path: str, columnIndex: int, headerRows: int = 1):
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f, delimiter=csv_delimiter(path))
+        for rowNumber, row in enumerate(reader):
+            if rowNumber >= headerRows and columnIndex < len(row):
+                yield row[columnIndex]
+
+def iter_text(path: str):
+    """One ID per line."""
+    with open(path, encoding='utf-8-sig') as f:
+        for line in f:
+            yield line
+
+def column_count(path: str, sheetName=0)->int:
+    """Number of columns in the requested sheet, or in the widest row of a CSV. Text files have one."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        from openpyxl import load_workbook
+        wb = load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb.worksheets[sheetName] if isinstance(sheetName, int) else wb[sheetName]
+            if ws.max_column:
+                return ws.max_column
+            return max((len(row) for row in ws.iter_rows(values_only=True)), default=0)  # No stored dimensions
+        finally:
+            wb.close()
+    if ext == '.xls':
+        import pandas as pd
+        return len(pd.read_excel(path, sheet_name=sheetName, header=None, nrows=1).columns)
+    if ext in ('.csv', '.tsv'):
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            return max((len(row) for row in csv.reader(f, delimiter=csv_delimiter(path))), default=0)
+    return 1
+
+def iter_ids(path: str, sheetName=0, columnIndex: int = 0):
+    """Yields the raw, non-empty values of the requested column based on the file extension."""
+    ext = os.path.splitext(path)[1].lower()
+    if ext in ('.xlsx', '.xlsm'):
+        values = iter_excel(path, sheetName, columnIndex)
+    elif ext == '.xls':
+        values = iter_xls(path, sheetName, columnIndex)
+    elif ext in ('.csv', '.tsv'):
+        values = iter_csv(path, columnIndex)
+    else:
+        values = iter_text(path)
+    for value in values:
+        if value is not None and value == value and str(value).strip():  # value == value drops NaN
+            yield value
+
+def load_ids(path: str, sheetName=0, columnIndex: int = 0, cacheDir: str = LOT_CACHE_DIR)->IDIndex:
+    """Returns the IDs of one sheet and column as a compiled index.
+       The parsed result is cached by file content, sheet and column, so reopening a lot file only costs
+       hashing it and memory-mapping the cached index. The column is only checked against the file when
+       there is no cached index for it; raises IndexError if it is out of range."""
+    key = hashlib.sha256(f"{file_digest(path)}|{sheetName}|{columnIndex}".encode('utf-8')).hexdigest()
+    cachePath = os.path.join(cacheDir, key + '.idx')
+    if os.path.exists(cachePath):
+        try:
+            return IDIndex.load(cachePath)
+        except (OSError, ValueError) as e:
+            print(f"Ignoring unreadable ID cache {cachePath}: {e}")
+    if not 0 <= columnIndex < column_count(path, sheetName):
+        raise IndexError(f"Column index '{columnIndex}' is out of range.")
+    index = IDIndex.build(iter_ids(path, sheetName, columnIndex))
+    os.makedirs(cacheDir, exist_ok=True)
+    index.save(cachePath)
+    return index
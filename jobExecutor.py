@@ -0,0 +1,278 @@
+import functools
+import json
+import queue
+import threading
+import time
+
+import asyncSort
+import handlerFunctions
+from idIndex import compile_ids, VersionedIDSet
+from srq import SrqDispatcher
+
+PASS_BIN = 1
+
+# Job states reported to clients
+IDLE = "idle"
+QUEUED = "queued"
+RUNNING = "running"
+STOPPING = "stopping"
+DONE = "done"
+STOPPED = "stopped"
+FAILED = "failed"
+
+class JobStatus:
+    """Progress counters of a single sort job."""
+    def __init__(self, address: str = None, numParts: int = 0):
+        self.state = IDLE
+        self.address = address
+        self.numParts = numParts
+        self.partsDone = 0
+        self.passed = 0
+        self.failed = 0
+        self.startTime = None
+        self.endTime = None
+        self.error = None
+        self.idVersion = 0
+        self.idCount = 0
+        # Names the lot in the results database, unique per job on this handler
+        self.lot = f"{address}/{time.strftime('%Y%m%d-%H%M%S')}" if address else None
+
+    def parts_per_hour(self)->float:
+        if self.startTime is None or self.partsDone == 0:
+            return 0.0
+        elapsed = (self.endTime or time.monotonic()) - self.startTime
+        return self.partsDone * 3600.0 / elapsed if elapsed > 0 else 0.0
+
+    def to_dict(self)->dict:
+        return {
+            "state": self.state,
+            "address": self.address,
+            "lot": self.lot,
+            "numParts": self.numParts,
+            "partsDone": self.partsDone,
+            "pass": self.passed,
+            "fail": self.failed,
+            "partsPerHour": round(self.parts_per_hour(), 1),
+            "idVersion": self.idVersion,
+            "idCount": self.idCount,
+            "error": self.error,
+        }
+
+class JobExecutor:
+    """Runs sort jobs on a worker thread so the D-Bus main loop is never blocked by a lot.
+       submit() returns immediately, listeners are called from the worker thread whenever the status changes."""
+    def __init__(self, runner=handlerFunctions.main, progressInterval: int = 1, srqDispatcher=None, ready=None):
+        self._runner = runner
+        self._ready = ready  # Called before each job, blocks until the bus is usable or raises
+        self._srqDispatcher = srqDispatcher
+        self._jobs = queue.Queue()
+        self._stopEvent = threading.Event()
+        self._listeners = []
+        self._resultListeners = []
+        self._recordListeners = []
+        self.progressInterval = progressInterval
+        self.status = JobStatus()
+        self.ids = None  # VersionedIDSet of the running job
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_listener(self, callback):
+        """Registers callback(status) for status changes."""
+        self._listeners.append(callback)
+
+    def add_result_listener(self, callback):
+        """Registers callback(ID, bin, cycleTime, site) for every sorted part, called from the job thread."""
+        self._resultListeners.append(callback)
+
+    def add_record_listener(self, callback):
+        """Registers callback(status, ID, bin, cycleTime, site) for every sorted part, status naming the lot."""
+        self._recordListeners.append(callback)
+
+    def _result(self, ID, bin, cycleTime, site=1):
+        for callback in self._resultListeners:
+            try:
+                callback(ID, bin, cycleTime, site)
+            except Exception as e:
+                print(f"Result listener failed: {e}")
+        for callback in self._recordListeners:
+            try:
+                callback(self.status, ID, bin, cycleTime, site)
+            except Exception as e:
+                print(f"Record listener failed: {e}")
+
+    def is_busy(self)->bool:
+        return self.status.state in (QUEUED, RUNNING, STOPPING)
+
+    def submit(self, address: str, IDset, numParts: int = 30000, profile: str = None)->bool:
+        """Queues a job using the named handler profile. Returns False if a job is already queued or running."""
+        if self.is_busy():
+            print("A job is already running. Ignoring new job.")
+            return False
+        self.status = JobStatus(address, numParts)
+        self.status.state = QUEUED
+        self._notify()
+        self._jobs.put((address, IDset, numParts, profile))
+        return True
+
+    def apply_delta(self, add=(), remove=())->int:
+        """Adds and removes accepted IDs of the running job, effective from its next sort cycle.
+           Returns the new ID set version, or None if no job is running."""
+        ids = self.ids
+        if ids is None or self.status.state not in (RUNNING, STOPPING):
+            return None
+        version = ids.apply(add, remove)
+        self.status.idVersion = version
+        self.status.idCount = len(ids)
+        self._notify()
+        return version
+
+    def stop(self):
+        """Asks the running job to stop after the current part, or right away if it is waiting for one."""
+        if self.status.state == RUNNING:
+            self.status.state = STOPPING
+            self._stopEvent.set()
+            self._notify()
+
+    def get_payload(self)->bytes:
+        return json.dumps(self.status.to_dict()).encode('utf-8')
+
+    def _notify(self):
+        for callback in self._listeners:
+            try:
+                callback(self.status)
+            except Exception as e:
+                print(f"Job listener failed: {e}")
+
+    def _progress(self, bin):
+        status = self.status
+        status.partsDone += 1
+        if bin == PASS_BIN:
+            status.passed += 1
+        else:
+            status.failed += 1
+        if status.partsDone % self.progressInterval == 0:
+            self._notify()
+
+    def _run(self):
+        while True:
+            address, IDset, numParts, profile = self._jobs.get()
+            status = self.status
+            self._stopEvent.clear()
+            try:
+                # The job stays queued until the GPIB board is configured
+                if self._ready is not None:
+                    self._ready()
+                status.state = RUNNING
+                status.startTime = time.monotonic()
+                self._notify()
+                # Compiled once per ID list, later jobs with the same list load it from the cache
+                IDset = self.ids = VersionedIDSet(compile_ids(IDset))
+                status.idCount = len(IDset)
+                self._runner(GPIBaddr=address, numParts=numParts, IDset=IDset,
+                             progress=self._progress, stopEvent=self._stopEvent, onResult=self._result,
+                             profile=profile, srqDispatcher=self._srqDispatcher)
+                status.state = STOPPED if self._stopEvent.is_set() else DONE
+            except Exception as e:
+                print(f"Job failed: {e}")
+                status.error = str(e)
+                status.state = FAILED
+            self.ids = None
+            status.endTime = time.monotonic()
+            self._notify()
+
+class JobManager:
+    """Runs independent jobs on several handlers sharing one GPIB bus.
+       Each address gets its own JobExecutor with its own ID index, counters and lifecycle. Bus transactions
+       are arbitrated by gpibBus.BUS_LOCK ahead of scans, sessions are kept open by sessionPool, and once several jobs run at the same time their service requests are routed by one SrqDispatcher.
+       Handlers given a transport with set_transport() are sorted by asyncSort over that transport instead."""
+    def __init__(self, runner=handlerFunctions.main, ready=None):
+        self._runner = runner
+        self._ready = ready
+        self._executors = {}
+        self._listeners = []
+        self._resultListeners = []
+        self._recordListeners = []
+        self.dispatcher = SrqDispatcher()
+        self._transports = {}
+
+    def add_listener(self, callback):
+        """Registers callback(status) for status changes of any job."""
+        self._listeners.append(callback)
+
+    def add_result_listener(self, callback):
+        """Registers callback(ID, bin, cycleTime, site) for every part sorted by any job."""
+        self._resultListeners.append(callback)
+
+    def add_record_listener(self, callback):
+        """Registers callback(status, ID, bin, cycleTime, site) for every part sorted by any job."""
+        self._recordListeners.append(callback)
+
+    def get(self, address: str)->JobExecutor:
+        executor = self._executors.get(address)
+        if executor is None:
+            executor = JobExecutor(self._runner, srqDispatcher=self.dispatcher, ready=self._ready)
+            self._use_transport(address, executor)
+            for callback in self._listeners:
+                executor.add_listener(callback)
+            for callback in self._resultListeners:
+                executor.add_result_listener(callback)
+            for callback in self._recordListeners:
+                executor.add_record_listener(callback)
+            self._executors[address] = executor
+        return executor
+
+    def set_transport(self, address: str, factory):
+        """Sorts the handler at address over factory(address), a transport.Transport such as
+           AR488Transport.for_address, from its next job on. The job then skips the GPIB ready gate."""
+        self._transports[address] = factory
+        if address in self._executors:
+            self._use_transport(address, self._executors[address])
+
+    def _use_transport(self, address: str, executor: JobExecutor):
+        factory = self._transports.get(address)
+        if factory is not None:
+            executor._runner = functools.partial(asyncSort.main, transportFactory=factory)
+            executor._ready = None
+
+    def submit(self, address: str, IDset, numParts: int = 30000, profile: str = None)->bool:
+        """Starts a job on the handler at address, unless that handler is already busy."""
+        return self.get(address).submit(address, IDset, numParts, profile)
+
+    def stop(self, address: str = None):
+        """Stops the job on one handler, or every job when no address is given."""
+        if address is None:
+            for executor in self._executors.values():
+                executor.stop()
+        elif address in self._executors:
+            self._executors[address].stop()
+
+    def apply_delta(self, address: str, add=(), remove=())->int:
+        """Changes the accepted IDs of the job running on address, returns the new version or None."""
+        executor = self._executors.get(address)
+        return executor.apply_delta(add, remove) if executor is not None else None
+
+    def is_busy(self, address: str = None)->bool:
+        if address is not None:
+            return address in self._executors and self._executors[address].is_busy()
+        return any(executor.is_busy() for executor in self._executors.values())
+
+    def get_payload(self)->bytes:
+        """Status of every job keyed by address as UTF-8 JSON."""
+        return json.dumps({address: executor.status.to_dict()
+                           for address, executor in self._executors.items()}).encode('utf-8')
+
+def validate_delta(delta)->dict:
+    """Checks an ID delta {"address": ..., "add": [...], "remove": [...]} and returns it. Raises ValueError
+       if it is not usable, in particular for a bare string, which would otherwise be applied per character."""
+    if not isinstance(delta, dict):
+        raise ValueError("delta must be a JSON object")
+    unknown = set(delta) - {"address", "add", "remove"}
+    if unknown:
+        raise ValueError(f"unknown keys: {', '.join(sorted(unknown))}")
+    if delta.get("address") is not None and not isinstance(delta["address"], str):
+        raise ValueError('"address" must be a string')
+    for key in ("add", "remove"):
+        IDs = delta.get(key, [])
+        if not isinstance(IDs, list) or not all(isinstance(ID, str) for ID in IDs):
+            raise ValueError(f'"{key}" must be a list of strings')
+    return delta
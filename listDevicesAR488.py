@@ -1,31 +1,25 @@
-from AR488Monitor import AR488Monitor
-import time
+from AR488Monitor import get_connection
+
+FNDL_TIMEOUT = 1.0  # Seconds to wait for the first ++fndl line
+IDN_TIMEOUT = 1.0   # Seconds to wait for an *IDN? response
 
 def list_devices():
-    """List all GPIB devices connected to the system."""
-    monitor1 = AR488Monitor()
-    monitor1.write("++fndl")
-    time.sleep(0.1)
-    devices: list = monitor1.get_buffer().splitlines()
-    devices = [line.strip() for line in devices if line.strip()]
-    monitor1.close()
-    
-    monitor2 = AR488Monitor()
-    ret_devices = {}
-    if len(devices) > 0:
-        for device in devices:
-            monitor2.write(f"++addr {device}")
-            time.sleep(0.1)
-            monitor2.write("*IDN?")
-            time.sleep(0.1)
-            response = monitor2.get_buffer().strip()
-            if response:
-                ret_devices[f"GPIB0::{device}::INSTR"] = response
-            print(f"Device at address {device}: {response}")
-    else:
-        print("🔍 No devices found.")
+    """List all GPIB devices connected to the system.
+       Uses the shared AR488 connection, so only the first call pays for opening and resetting the board."""
+    connection = get_connection()
+    with connection.lock:  # Keep the scan from interleaving with other users of the adapter
+        devices = connection.query_lines("++fndl", timeout=FNDL_TIMEOUT)
+        
+        ret_devices = {}
+        if len(devices) > 0:
+            for device in devices:
+                response = connection.query("*IDN?", address=device, timeout=IDN_TIMEOUT)
+                if response:
+                    ret_devices[f"GPIB0::{device}::INSTR"] = response
+                print(f"Device at address {device}: {response}")
+        else:
+            print("🔍 No devices found.")
         
-    monitor2.close()
     return ret_devices
 
 if __name__ == "__main__":
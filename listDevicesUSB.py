@@ -1,26 +1,120 @@
-import pyvisa
-
-def list_usb_devices():
-    """List all USB devices connected to the system."""
-    rm = pyvisa.ResourceManager()
-    print("Opened Resource Manager")
-    
-    possible_addresses = [f"GPIB0::{i}::INSTR" for i in range(1, 32)]
-    
-    print("Checking possible GPIB addresses...")
-    usb_devices = {}
-    for device in possible_addresses:
-        print(f"Checking {device}...")
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import metrics
+from gpibBus import BUS_LOCK, SCAN
+from sessionPool import SessionPool, get_pool
+
+SCAN_TIME = metrics.histogram("scan", "GPIB device scan")
+
+GPIB_BOARD = 0
+GPIB_ADDRESSES = range(1, 31)  # Valid primary addresses (0 is the controller)
+SCAN_BUDGET = 1.0              # Seconds allowed for a whole bus scan
+PROBE_TIMEOUT = 100            # Per-address VISA timeout in ms for the fallback probe
+IDN_TIMEOUT = 500              # VISA timeout in ms for *IDN? on a known listener
+MAX_PROBE_WORKERS = 8
+
+def find_listeners(board: int = GPIB_BOARD, addresses=GPIB_ADDRESSES)->list:
+    """FindLstn-style poll of the bus using linux-gpib, returns the addresses that have a listener.
+       Returns None if the linux-gpib bindings are not available so the caller can fall back."""
+    try:
+        import gpib
+    except ImportError:
+        return None
+
+    listeners = []
+    try:
+        for pad in addresses:
+            # ibln only addresses the device and checks NDAC, no data is transferred
+            with BUS_LOCK.priority(SCAN):
+                present = gpib.listener(board, pad)
+            if present:
+                listeners.append(pad)
+    except Exception as e:
+        print(f"Listener poll failed, falling back to per-address probes: {e}")
+        return None
+    return listeners
+
+def _check_deadline(deadline: float):
+    if time.monotonic() >= deadline:
+        raise TimeoutError("Scan budget exceeded")
+
+def _probe(pool: SessionPool, device: str, timeout: int, deadline: float)->str:
+    """Queries *IDN? on the pooled session of a single address, or returns None if nothing answered.
+       The write and the read are separate bus transactions at scan priority, so the bus is only held while
+       data moves and an empty address, which fails the write for lack of listeners, costs almost nothing.
+       Addresses leased by a running job are not touched, sessions to addresses that did not answer are
+       closed again, and a probe that only gets to run after the deadline does not send the query at all."""
+    if pool.leased(device):
+        return pool.idn.get(device)
+    remaining = int((deadline - time.monotonic()) * 1000)
+    if remaining <= 0:
+        return None
+    try:
+        resource = pool.open(device)
+        previous = resource.timeout
+        resource.timeout = min(timeout, remaining)
         try:
-            resource = rm.open_resource(device)
-            resource.timeout = 500  # Set timeout to 0.5 seconds
-            idn = resource.query('*IDN?')
-            usb_devices[device] = idn.strip()
-            print(f"Found device at {device}: {idn.strip()}")
-            resource.close()
-        except Exception as e:
-            print(f"Failed to connect to {device}: {str(e)}")
-    
+            with BUS_LOCK.priority(SCAN):
+                _check_deadline(deadline)  # The bus may only have come free after the scan gave up
+                resource.write('*IDN?')
+            # Once the query is out the reply is always read, bounded by the clamped timeout, so a late probe
+            # never leaves an unread IDN in the device's output queue for the next job
+            with BUS_LOCK.priority(SCAN):
+                idn = resource.read().strip()
+        finally:
+            resource.timeout = previous
+    except Exception:
+        pool.idn.pop(device, None)
+        if not pool.leased(device):
+            pool.discard(device)
+        return None
+    pool.idn[device] = idn
+    return idn
+
+def _query_all(pool: SessionPool, devices: list, timeout: int, deadline: float)->dict:
+    """Runs *IDN? against the given addresses concurrently, stopping at the deadline."""
+    found = {}
+    if not devices:
+        return found
+
+    executor = ThreadPoolExecutor(max_workers=min(MAX_PROBE_WORKERS, len(devices)))
+    futures = {executor.submit(_probe, pool, device, timeout, deadline): device for device in devices}
+    done, pending = wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    for future in done:
+        idn = future.result()
+        if idn:
+            found[futures[future]] = idn
+    for future in pending:
+        print(f"Scan budget exceeded before {futures[future]} answered")
+    # Probes still queued are dropped, running ones end within their clamped timeout
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    # Keep the result ordered by address like the sequential scan did
+    return {device: found[device] for device in devices if device in found}
+
+def list_usb_devices(budget: float = SCAN_BUDGET, board: int = GPIB_BOARD, rm=None)->dict:
+    """List all GPIB devices connected to the system.
+       Listeners are located in one bulk poll, and only those get an *IDN? query. If the bulk poll is
+       unavailable, every address is probed concurrently. The whole scan is bounded by `budget` seconds."""
+    start = time.monotonic()
+    deadline = start + budget
+    pool = get_pool() if rm is None else SessionPool(rm)
+
+    listeners = find_listeners(board)
+    if listeners is not None:
+        print(f"Listeners found at: {listeners}")
+        devices = [f"GPIB{board}::{pad}::INSTR" for pad in listeners]
+        usb_devices = _query_all(pool, devices, IDN_TIMEOUT, deadline)
+    else:
+        print("Bulk listener poll unavailable, probing all addresses...")
+        devices = [f"GPIB{board}::{pad}::INSTR" for pad in GPIB_ADDRESSES]
+        usb_devices = _query_all(pool, devices, PROBE_TIMEOUT, deadline)
+
+    for device, idn in usb_devices.items():
+        print(f"Found device at {device}: {idn}")
+    SCAN_TIME.observe_ns(int((time.monotonic() - start) * 1e9))
+    print(f"Scan finished in {time.monotonic() - start:.3f}s")
     return usb_devices
 
 if __name__ == "__main__":
@@ -30,4 +124,4 @@ if __name__ == "__main__":
         for device, idn in devices.items():
             print(f"{device}: {idn}")
     else:
-        print("No USB devices found.")
\ No newline at end of file
+        print("No USB devices found.")
@@ -0,0 +1,170 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Bucket upper bounds in nanoseconds: 1-2-5 steps from 10 us to 100 s
+BUCKETS_NS = [m * 10 ** e for e in range(4, 11) for m in (1, 2, 5)] + [10 ** 11]
+PROMETHEUS_FILE = '/var/lib/node_exporter/textfile_collector/rpi_sort.prom'
+EXPORT_INTERVAL = 15.0
+MAX_PAYLOAD = 512  # Longest attribute value ATT allows
+
+now_ns = time.perf_counter_ns
+
+class Histogram:
+    """Fixed-bucket latency histogram. observe() is one bisect and a few additions under a lock,
+       percentiles are estimated from the bucket bounds when read."""
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.counts = [0] * (len(BUCKETS_NS) + 1)  # Last bucket catches everything above the largest bound
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def observe_ns(self, value: int):
+        i = bisect.bisect_left(BUCKETS_NS, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            if value > self.max:
+                self.max = value
+
+    def since(self, start: int)->int:
+        """Records the time elapsed since a now_ns() reading and returns the current reading, so phases can be chained."""
+        end = now_ns()
+        self.observe_ns(end - start)
+        return end
+
+    def percentile(self, q: float)->int:
+        """Estimate in ns of the q-th quantile, interpolated within its bucket and capped at the observed max."""
+        with self._lock:
+            counts = list(self.counts)
+            total = self.count
+            largest = self.max
+        if not total:
+            return 0
+        rank = q * total
+        seen = 0
+        for i, c in enumerate(counts):
+            if c and seen + c >= rank:
+                lower = BUCKETS_NS[i - 1] if i > 0 else 0
+                upper = BUCKETS_NS[i] if i < len(BUCKETS_NS) else largest
+                return int(min(lower + (upper - lower) * (rank - seen) / c, largest))
+            seen += c
+        return largest
+
+    def summary(self)->dict:
+        """Milliseconds, rounded for a compact payload."""
+        ms = lambda ns: round(ns / 1e6, 3)
+        return {
+            "count": self.count,
+            "p50": ms(self.percentile(0.50)),
+            "p95": ms(self.percentile(0.95)),
+            "p99": ms(self.percentile(0.99)),
+            "max": ms(self.max),
+        }
+
+class Counter:
+    def __init__(self, name: str, help: str = ""):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: int = 1):
+        with self._lock:
+            self.value += amount
+
+_histograms = {}
+_counters = {}
+_registryLock = threading.Lock()
+
+def histogram(name: str, help: str = "")->Histogram:
+    """Returns the histogram registered under name, creating it on first use."""
+    with _registryLock:
+        if name not in _histograms:
+            _histograms[name] = Histogram(name, help)
+        return _histograms[name]
+
+def counter(name: str, help: str = "")->Counter:
+    with _registryLock:
+        if name not in _counters:
+            _counters[name] = Counter(name, help)
+        return _counters[name]
+
+def snapshot()->dict:
+    return {
+        "histograms": {name: h.summary() for name, h in _histograms.items()},
+        "counters": {name: c.value for name, c in _counters.items()},
+    }
+
+def histogram_names()->list:
+    return list(_histograms)
+
+def get_payload(names=None, limit: int = MAX_PAYLOAD)->bytes:
+    """Compact JSON for BLE: {"c": {counter: value}, "h": {histogram: [count, p50, p95, p99, max]}} in ms.
+       names selects histograms, all by default. Histograms that would push the value past limit bytes are
+       left out and counted in "more", so the client can select them by name instead."""
+    encode = lambda value: json.dumps(value, separators=(',', ':')).encode('utf-8')
+    payload = {"c": {name: c.value for name, c in _counters.items()}, "h": {}}
+    more = 0
+    for name in (histogram_names() if names is None else names):
+        h = _histograms.get(name)
+        if h is None:
+            continue
+        summary = h.summary()
+        payload["h"][name] = [summary["count"], summary["p50"], summary["p95"], summary["p99"], summary["max"]]
+        if len(encode(dict(payload, more=more + 1))) > limit:
+            del payload["h"][name]
+            more += 1
+    if more:
+        payload["more"] = more
+    return encode(payload)
+
+def prometheus_text()->str:
+    lines = []
+    for name, c in _counters.items():
+        lines.append(f"# HELP rpi_sort_{name}_total {c.help}")
+        lines.append(f"# TYPE rpi_sort_{name}_total counter")
+        lines.append(f"rpi_sort_{name}_total {c.value}")
+    for name, h in _histograms.items():
+        metric = f"rpi_sort_{name}_seconds"
+        lines.append(f"# HELP {metric} {h.help}")
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        for bound, c in zip(BUCKETS_NS, h.counts):
+            cumulative += c
+            lines.append(f'{metric}_bucket{{le="{bound / 1e9:g}"}} {cumulative}')
+        lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+        lines.append(f"{metric}_sum {h.sum / 1e9}")
+        lines.append(f"{metric}_count {h.count}")
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path: str = PROMETHEUS_FILE):
+    """Writes the node_exporter textfile atomically so a scrape never sees a partial file."""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(prometheus_text())
+    os.replace(tmp, path)
+
+def start_textfile_exporter(path: str = PROMETHEUS_FILE, interval: float = EXPORT_INTERVAL):
+    """Rewrites the textfile every interval seconds from a daemon thread, if its directory exists."""
+    if not os.path.isdir(os.path.dirname(path)):
+        print(f"Prometheus textfile directory for {path} not found, export disabled")
+        return None
+
+    def run():
+        while True:
+            try:
+                write_prometheus(path)
+            except OSError as e:
+                print(f"Prometheus export failed: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
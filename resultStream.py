@@ -0,0 +1,82 @@
+import struct
+import threading
+import time
+
+import metrics
+
+# site, bin, cycle time in ms, ID length, followed by the ID bytes
+RECORD = struct.Struct('<BBHB')
+MAX_ID_LENGTH = 255
+FLUSH_INTERVAL = 0.25  # Seconds a record may wait for more records to share its packet
+
+RESULTS_DROPPED = metrics.counter("results_dropped", "Results too large for a result stream packet")
+
+def pack_result(ID: str, bin: int, cycleTime: float, site: int = 1)->bytes:
+    key = ID.encode('utf-8')[:MAX_ID_LENGTH]
+    ms = min(int(cycleTime * 1000), 0xFFFF)
+    return RECORD.pack(site, bin, ms, len(key)) + key
+
+def unpack_results(packet: bytes)->list:
+    """Client side helper that splits a notification back into (site, bin, cycle ms, ID) tuples."""
+    results = []
+    offset = 0
+    while offset < len(packet):
+        site, bin, ms, length = RECORD.unpack_from(packet, offset)
+        offset += RECORD.size
+        results.append((site, bin, ms, packet[offset:offset + length].decode('utf-8')))
+        offset += length
+    return results
+
+class ResultBatcher:
+    """Packs per-part results into packets no larger than maxPayload.
+       A packet is handed to on_packet() as soon as the next record would not fit, or once its oldest
+       record has waited flushInterval seconds, so a fast handler produces full packets and a slow one
+       still shows each decision promptly."""
+    def __init__(self, on_packet, maxPayload: int = 20, flushInterval: float = FLUSH_INTERVAL):
+        self.on_packet = on_packet
+        self.maxPayload = maxPayload
+        self.flushInterval = flushInterval
+        self._buffer = bytearray()
+        self._oldest = None
+        self.dropped = 0  # Records too large for a single packet
+        self._lock = threading.Lock()
+
+    def add(self, ID: str, bin: int, cycleTime: float, site: int = 1)->bool:
+        """Queues one record, returns False if it is larger than a whole packet and was dropped."""
+        record = pack_result(ID, bin, cycleTime, site)
+        packets = []
+        with self._lock:
+            if len(record) > self.maxPayload:
+                # Counted rather than printed, this runs on the job thread for every part
+                self.dropped += 1
+                RESULTS_DROPPED.inc()
+                if self.dropped == 1:
+                    print(f"Dropping results larger than the {self.maxPayload} byte payload ({ID} needs "
+                          f"{len(record)} bytes), further drops are only counted")
+                return False
+            if self._buffer and len(self._buffer) + len(record) > self.maxPayload:
+                packets.append(self._take())
+            self._buffer += record
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._buffer) >= self.maxPayload or time.monotonic() - self._oldest >= self.flushInterval:
+                packets.append(self._take())
+        for packet in packets:
+            self.on_packet(packet)
+        return True
+
+    def flush(self, force: bool = False):
+        """Sends the partial packet if it has waited long enough, or unconditionally when forced."""
+        with self._lock:
+            if not self._buffer:
+                return
+            if not force and time.monotonic() - self._oldest < self.flushInterval:
+                return
+            packet = self._take()
+        self.on_packet(packet)
+
+    def _take(self)->bytes:
+        packet = bytes(self._buffer)
+        self._buffer.clear()
+        self._oldest = None
+        return packet
@@ -0,0 +1,193 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from batchWriter import BatchWriter
+from metrics import MAX_PAYLOAD
+
+RESULTS_DB = os.path.expanduser('~/.local/share/rpi-sort/results.sqlite3')
+PASS_BIN = 1
+FLUSH_INTERVAL = 0.5  # Seconds a record may sit in memory before it is committed
+BATCH_SIZE = 512      # Records committed per transaction at most
+RECENT_LOTS = 5       # Lots returned by get_payload() by default
+MAX_RECENT_LOTS = 100
+
+# Raw rows, plus per-lot aggregates kept up to date by triggers so summaries never scan the rows.
+# lot_ids counts how often each ID was sorted in a lot; an ID reaching two counts as one duplicate.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    ts REAL NOT NULL, lot TEXT NOT NULL, address TEXT, part_id TEXT NOT NULL,
+    site INTEGER NOT NULL, bin INTEGER NOT NULL, cycle_ms REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS results_lot ON results (lot);
+CREATE INDEX IF NOT EXISTS results_part_id ON results (part_id);
+
+CREATE TABLE IF NOT EXISTS lots (
+    lot TEXT PRIMARY KEY, address TEXT, first_ts REAL, last_ts REAL,
+    parts INTEGER NOT NULL DEFAULT 0, passed INTEGER NOT NULL DEFAULT 0, failed INTEGER NOT NULL DEFAULT 0,
+    duplicates INTEGER NOT NULL DEFAULT 0, cycle_ms_sum REAL NOT NULL DEFAULT 0);
+
+CREATE TABLE IF NOT EXISTS lot_ids (
+    lot TEXT NOT NULL, part_id TEXT NOT NULL, count INTEGER NOT NULL,
+    PRIMARY KEY (lot, part_id)) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS results_aggregate AFTER INSERT ON results BEGIN
+    INSERT INTO lots (lot, address, first_ts, last_ts, parts, passed, failed, cycle_ms_sum)
+    VALUES (NEW.lot, NEW.address, NEW.ts, NEW.ts, 1, NEW.bin = {pass_bin}, NEW.bin != {pass_bin}, NEW.cycle_ms)
+    ON CONFLICT (lot) DO UPDATE SET
+        last_ts = MAX(last_ts, excluded.last_ts), parts = parts + 1,
+        passed = passed + excluded.passed, failed = failed + excluded.failed,
+        cycle_ms_sum = cycle_ms_sum + excluded.cycle_ms_sum;
+    INSERT INTO lot_ids (lot, part_id, count) VALUES (NEW.lot, NEW.part_id, 1)
+    ON CONFLICT (lot, part_id) DO UPDATE SET count = count + 1;
+END;
+
+CREATE TRIGGER IF NOT EXISTS lot_ids_duplicate AFTER UPDATE OF count ON lot_ids
+WHEN NEW.count = 2 BEGIN
+    UPDATE lots SET duplicates = duplicates + 1 WHERE lot = NEW.lot;
+END;
+""".format(pass_bin=PASS_BIN)
+
+LOT_COLUMNS = "lot, address, first_ts, last_ts, parts, passed, failed, duplicates, cycle_ms_sum"
+
+def _lot_dict(row)->dict:
+    lot, address, first, last, parts, passed, failed, duplicates, cycleSum = row
+    elapsed = (last - first) if first is not None and last is not None else 0
+    return {
+        "lot": lot,
+        "address": address,
+        "start": first,
+        "end": last,
+        "parts": parts,
+        "pass": passed,
+        "fail": failed,
+        "yield": round(passed / parts, 4) if parts else 0.0,
+        "duplicates": duplicates,
+        "partsPerHour": round((parts - 1) * 3600.0 / elapsed, 1) if elapsed > 0 else 0.0,
+        "avgCycleMs": round(cycleSum / parts, 3) if parts else 0.0,
+    }
+
+class ResultsDb(BatchWriter):
+    """Records every sort decision in a SQLite database in WAL mode.
+       record() only queues a tuple, a background thread commits the queue in batches, one transaction per
+       batch, so the sort loop never waits on the disk. Queries run on their own connection and read the
+       per-lot aggregates maintained by triggers instead of the raw rows."""
+    def __init__(self, path: str = RESULTS_DB, flushInterval: float = FLUSH_INTERVAL):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._writer = None
+        self._readLock = threading.Lock()
+        self._reader = None
+        BatchWriter.__init__(self, flushInterval, BATCH_SIZE)  # Schema exists before the first query
+
+    def _connect(self)->sqlite3.Connection:
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")  # Durable at checkpoints, no fsync per transaction
+        return db
+
+    def record(self, lot: str, address: str, ID: str, bin: int, cycleTime: float, site: int = 1):
+        """Queues one decision, cycleTime in seconds. Never blocks on the database."""
+        self.put((time.time(), lot, address, ID, site, bin, cycleTime * 1000))
+
+    def on_result(self, status, ID, bin, cycleTime, site=1):
+        """Record listener for JobManager.add_record_listener()."""
+        self.record(status.lot, status.address, ID, bin, cycleTime, site)
+
+    def _start(self):
+        self._writer = self._connect()
+        self._writer.executescript(SCHEMA)
+
+    def _write(self, batch: list):
+        try:
+            with self._writer:
+                self._writer.executemany("INSERT INTO results (ts, lot, address, part_id, site, bin, cycle_ms) "
+                                         "VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+        except sqlite3.Error as e:
+            print(f"Failed to write results: {e}")
+
+    def _stop(self):
+        self._writer.close()
+
+    def _query(self, sql: str, args=())->list:
+        with self._readLock:
+            if self._reader is None:
+                self._reader = self._connect()
+            return self._reader.execute(sql, args).fetchall()
+
+    def lot_summary(self, lot: str)->dict:
+        """Pass/fail counts, yield, duplicates and throughput of one lot, or None if it has no results."""
+        rows = self._query(f"SELECT {LOT_COLUMNS} FROM lots WHERE lot = ?", (lot,))
+        return _lot_dict(rows[0]) if rows else None
+
+    def recent_lots(self, limit: int = RECENT_LOTS)->list:
+        rows = self._query(f"SELECT {LOT_COLUMNS} FROM lots ORDER BY last_ts DESC LIMIT ?", (limit,))
+        return [_lot_dict(row) for row in rows]
+
+    def find_id(self, ID: str)->list:
+        """Every decision recorded for a 2DID, newest first."""
+        rows = self._query("SELECT ts, lot, site, bin, cycle_ms FROM results WHERE part_id = ? ORDER BY ts DESC",
+                           (ID,))
+        return [{"ts": ts, "lot": lot, "site": site, "bin": bin, "cycleMs": round(ms, 3)}
+                for ts, lot, site, bin, ms in rows]
+
+    def duplicate_ids(self, lot: str)->list:
+        return [ID for (ID,) in self._query("SELECT part_id FROM lot_ids WHERE lot = ? AND count > 1", (lot,))]
+
+    def get_payload(self, query: dict = None, limit: int = MAX_PAYLOAD)->bytes:
+        """UTF-8 JSON for a query {"lot": name}, {"id": 2DID} or {"recent": n}, the recent lots by default.
+           A lot comes back as one summary (null if unknown), the other queries as {"lots": [...]} or
+           {"results": [...]}, newest first. Rows that would push the value past limit bytes are left out and
+           counted in "more", so the client can ask for a single lot instead."""
+        query = validate_query(query)
+        if "lot" in query:
+            return _encode(self.lot_summary(query["lot"]))
+        if "id" in query:
+            return _fit("results", self.find_id(query["id"]), limit)
+        return _fit("lots", self.recent_lots(query.get("recent", RECENT_LOTS)), limit)
+
+def _encode(value)->bytes:
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+def _fit(key: str, rows: list, limit: int)->bytes:
+    """{key: rows} trimmed to the newest rows that fit in limit bytes, with the rest counted in "more"."""
+    size = len(_encode({key: [], "more": len(rows)}))
+    fitting = 0
+    for row in rows:
+        size += len(_encode(row)) + 1  # Separating comma
+        if size > limit:
+            break
+        fitting += 1
+    payload = {key: rows[:fitting]}
+    if fitting < len(rows):
+        payload["more"] = len(rows) - fitting
+    return _encode(payload)
+
+def validate_query(query)->dict:
+    """Checks a get_payload() query and returns it, {} for None. Raises ValueError if it is not usable."""
+    if query is None:
+        return {}
+    if not isinstance(query, dict):
+        raise ValueError("query must be a JSON object")
+    if len(query) > 1 or not set(query) <= {"lot", "id", "recent"}:
+        raise ValueError('query takes one of "lot", "id" or "recent"')
+    for key in ("lot", "id"):
+        if key in query and not isinstance(query[key], str):
+            raise ValueError(f'"{key}" must be a string')
+    recent = query.get("recent", RECENT_LOTS)
+    if isinstance(recent, bool) or not isinstance(recent, int) or not 1 <= recent <= MAX_RECENT_LOTS:
+        raise ValueError(f'"recent" must be a whole number from 1 to {MAX_RECENT_LOTS}')
+    return query
+
+_db = None
+_dbLock = threading.Lock()
+
+def get_results_db()->ResultsDb:
+    """Returns the process-wide results database, opening it on first use."""
+    global _db
+    with _dbLock:
+        if _db is None:
+            _db = ResultsDb()
+    return _db
@@ -21,30 +21,47 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import signal
+
 import dbus
+try:
+  from gi.repository import GObject, GLib
+except ImportError:
+    import gobject as GObject
+    GLib = None
 
 from advertisement import Advertisement
-from service import Application, Service, Characteristic, Descriptor
+from service import Application, Service, Characteristic, InvalidArgsException, FailedException
 
 #from listDevices import list_devices
-from listDevicesUSB import list_usb_devices
+from deviceInventory import DeviceInventory, INVENTORY_TTL
+
 import json
 
-from handlerFunctions import main
-from gpib_usb_configure import configureDevice
+from jobExecutor import JobManager, validate_delta
+from transport import AR488Transport
+from uploadProtocol import UploadAssembler, is_frame
+from resultStream import ResultBatcher
+from resultsDb import get_results_db, validate_query
+from commLog import get_logger
+import metrics
+from gpib_usb_configure import configure_in_background, wait_until_ready, add_ready_listener
 
 
 GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
-NOTIFY_TIMEOUT = 5000
+RESULT_FLUSH_TIMEOUT = 250  # ms between checks for a partially filled result packet
+METRICS_NOTIFY_TIMEOUT = 5000
+DEVICES_NOTIFY_MIN_INTERVAL = 500   # ms between device list notifications
+STATUS_NOTIFY_MIN_INTERVAL = 250    # ms between job status notifications, per-part updates are coalesced
+HANDLER_PROFILE = "standard"  # See handlerFunctions.HANDLER_PROFILES
+AR488_ADDRESSES = ()  # Handlers behind the AR488 adapter, e.g. ("GPIB0::5::INSTR",), sorted over AR488Transport
 
 LOCAL_NAME = "rpi-sort"
-val_buffer = ''  # Global buffer to hold incoming values
 
 class BLEAdvertisement(Advertisement):
     def __init__(self, index):
         Advertisement.__init__(self, index, "peripheral")
         self.add_local_name(LOCAL_NAME)
-        configureDevice()  # Configure the GPIB device if needed
         # self.include_tx_power = True
 
 class BLEService(Service):
@@ -53,18 +70,37 @@ class BLEService(Service):
     def __init__(self, index):
         self.address = None
         self.ids: set = None
+        self.idsByAddress = {}  # Last ID upload for each handler
+        self.jobs = JobManager(ready=wait_until_ready)  # Jobs wait for the background GPIB configuration
+        self.results = get_results_db()
+        self.jobs.add_record_listener(self.results.on_result)
+        for address in AR488_ADDRESSES:
+            self.jobs.set_transport(address, AR488Transport.for_address)
 
         Service.__init__(self, index, self.BLE_SVC_UUID, True)
         self.add_characteristic(AvailableDevicesCharacteristic(self))
         self.add_characteristic(SendIDsCharacteristic(self))
         self.add_characteristic(SetAddressCharacteristic(self))
-
-    def sendJob(self):
-        print(f"Starting job with address: {self.address} and IDs: {self.ids}")
-        if self.address is not None and self.ids is not None:
-            main(GPIBaddr=self.address, IDset=set(self.ids))
+        self.add_characteristic(JobStatusCharacteristic(self))
+        self.add_characteristic(ResultStreamCharacteristic(self))
+        self.add_characteristic(JobControlCharacteristic(self))
+        self.add_characteristic(MetricsCharacteristic(self))
+        self.add_characteristic(LotResultsCharacteristic(self))
+        self.add_characteristic(IDDeltaCharacteristic(self))
+
+    def sendJob(self, address=None, numParts=30000, profile=HANDLER_PROFILE):
+        address = address or self.address
+        ids = self.idsByAddress.get(address)
+        print(f"Starting job with address: {address} and {len(ids or ())} IDs")
+        if address is not None and ids is not None:
+            # Returns immediately, the lot runs on that handler's worker thread
+            return self.jobs.submit(address, ids, numParts, profile)
         else:
             print("Address or IDs not set. Cannot start job.")
+            return False
+
+    def stopJob(self, address=None):
+        self.jobs.stop(address)
 
     def getAddress(self):
         return (self.address)
@@ -74,6 +110,8 @@ class BLEService(Service):
  
     def set_ids(self, ids):
         self.ids = ids
+        if self.address is not None:
+            self.idsByAddress[self.address] = ids
         
     def getIds(self):
         if self.ids is not None:
@@ -83,122 +121,94 @@ class BLEService(Service):
 
 class AvailableDevicesCharacteristic(Characteristic):
     GET_DEVICES_CHARACTERISTIC_UUID = "00000002-710e-4a5b-8d75-3e5b444bc3cf"
+    DESCRIPTION = "CPU Temperature"
+    NOTIFY_MIN_INTERVAL = DEVICES_NOTIFY_MIN_INTERVAL
+
     def __init__(self, service):
-        self.notifying = False
+        self.inventory = DeviceInventory(ttl=INVENTORY_TTL)
+        self.inventory.add_listener(self.on_inventory_changed)
 
         Characteristic.__init__(
                 self, self.GET_DEVICES_CHARACTERISTIC_UUID,
-                ["notify", "read"], service)
-        self.add_descriptor(TempDescriptor(self))
+                ["notify", "read", "write"], service)
+        # No scan at startup: the first one runs once the board is up, or on the first client request
+        add_ready_listener(self.on_gpib_ready)
+
+    def on_gpib_ready(self):
+        self.inventory.start()
+        self.inventory.refresh()  # Rescan if a client request already started the refresher
 
     def get_devices(self):
-        print("Looking for GPIB Devices...")
-        devices = list_usb_devices()
-        print("Found GPIB Devices: " + str(devices))
-        device_str = json.dumps(devices)
-        
+        # Served from the last background scan, the GPIB bus is never touched here
         # ✅ This fixes compatibility with Windows Chrome
-        value = dbus.ByteArray(device_str.encode('utf-8'))
+        self.inventory.start()
+        value = dbus.ByteArray(self.inventory.get_payload())
         return value
 
-    def set_get_device_callback(self):
-        if self.notifying:
-            value = self.get_devices()
-            self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
+    def get_notify_value(self):
+        return self.inventory.get_payload()
 
-        return self.notifying
+    def on_inventory_changed(self, devices):
+        # Called from the refresher thread, subscribers only hear about it if the payload differs
+        print("Found GPIB Devices: " + str(devices))
+        self.value_changed()
 
     def StartNotify(self):
-        if self.notifying:
-            return
-
-        self.notifying = True
-
-        value = self.get_devices()
-        print("GetDeviceCharacteristic StartNotify: " + str(value))
-        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": value}, [])
-        self.add_timeout(NOTIFY_TIMEOUT, self.set_get_device_callback)
+        print("GetDeviceCharacteristic StartNotify")
+        self.inventory.start()
+        self.start_notifying()
 
     def StopNotify(self):
-        self.notifying = False
+        self.stop_notifying()
 
     def ReadValue(self, options):
         value = self.get_devices()
 
         return value
 
-class TempDescriptor(Descriptor):
-    TEMP_DESCRIPTOR_UUID = "2901"
-    TEMP_DESCRIPTOR_VALUE = "CPU Temperature"
-
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.TEMP_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
-
-    def ReadValue(self, options):
-        value = []
-        desc = self.TEMP_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+    def WriteValue(self, value, options):
+        # Any write forces a rescan, the result is pushed to subscribers when it completes
+        print("Device rescan requested")
+        self.inventory.start()
+        self.inventory.refresh()
 
 class SendIDsCharacteristic(Characteristic):
     UNIT_CHARACTERISTIC_UUID = "00000003-710e-4a5b-8d75-3e5b444bc3cf"
+    DESCRIPTION = "Temperature Units (F or C)"
+    EOI_KEY = b'**!@ble-eoi@!**'
+    ACQUIRE_WRITE = True  # Bulk chunks arrive over a socket instead of one D-Bus call each
 
     def __init__(self, service):
         Characteristic.__init__(
                 self, self.UNIT_CHARACTERISTIC_UUID,
-                ["read", "write"], service)
-        self.add_descriptor(UnitDescriptor(self))
-
-    def WriteValue(self, value, options):
-        global val_buffer
-        
-        #convert value to string
-        EOI_KEY = '**!@ble-eoi@!**'
-        
-        incoming = ''.join([chr(b) for b in value]).strip()
-        if incoming == EOI_KEY:
-            values = val_buffer.split(',')
-            self.service.set_ids(set(values))
-            print(f"Received IDs: {values}")
-            self.service.sendJob()
-            val_buffer = ''
-            
-        else:
-            val_buffer += incoming
-
-    def ReadValue(self, options):
-        value = []
-
-        if self.service.is_farenheit(): val = "F"
-        else: val = "C"
-        value.append(dbus.Byte(val.encode()))
+                ["read", "write", "write-without-response"], service)
+        self.assembler = UploadAssembler(on_complete=self.on_ids_received)
+        self.legacy_chunks = []  # Legacy sentinel uploads, joined once at the end
 
-        return value
+    def on_ids_received(self, values):
+        self.service.set_ids(set(values))
+        print(f"Received {len(values)} IDs")
+        self.service.sendJob()
 
-class UnitDescriptor(Descriptor):
-    UNIT_DESCRIPTOR_UUID = "2901"
-    UNIT_DESCRIPTOR_VALUE = "Temperature Units (F or C)"
+    def WriteValue(self, value, options):
+        self.update_mtu(options)
+        # Framed uploads carry a header with length, chunk count and CRC, see uploadProtocol
+        if is_frame(value):
+            self.assembler.feed(value)
+            return
 
-    def __init__(self, characteristic):
-        Descriptor.__init__(
-                self, self.UNIT_DESCRIPTOR_UUID,
-                ["read"],
-                characteristic)
+        incoming = bytes(value).strip()
+        if incoming == self.EOI_KEY:
+            values = b''.join(self.legacy_chunks).decode('utf-8', errors='ignore').split(',')
+            self.legacy_chunks = []
+            self.on_ids_received(values)
+        else:
+            self.legacy_chunks.append(incoming)
 
     def ReadValue(self, options):
-        value = []
-        desc = self.UNIT_DESCRIPTOR_VALUE
-
-        for c in desc:
-            value.append(dbus.Byte(c.encode()))
-
-        return value
+        # Ack/status of the current framed upload, with the chunk size the client should use
+        self.update_mtu(options)
+        return dbus.ByteArray(self.assembler.get_payload(mtu=self.mtu))
 
 class SetAddressCharacteristic(Characteristic):
     UUID = '00000004-710e-4a5b-8d75-3e5b444b3c3f'  # ← Pick a new UUID
@@ -215,15 +225,252 @@ class SetAddressCharacteristic(Characteristic):
         self.service.set_address(command.strip())
         print(f"Address set to: {self.service.getAddress()}")
 
-app = Application()
-app.add_service(BLEService(0))
-app.register()
+class JobStatusCharacteristic(Characteristic):
+    UUID = "00000005-710e-4a5b-8d75-3e5b444bc3cf"
+    NOTIFY_MIN_INTERVAL = STATUS_NOTIFY_MIN_INTERVAL
 
-adv = BLEAdvertisement(0)
-adv.add_service_uuid(BLEService.BLE_SVC_UUID)
-adv.register()
+    def __init__(self, service):
+        Characteristic.__init__(self, self.UUID,
+                                ["read", "notify", "write"],
+                                service)
+        service.jobs.add_listener(self.on_status_changed)
 
-try:
-    app.run()
-except KeyboardInterrupt:
-    app.quit()
+    def get_status(self):
+        return dbus.ByteArray(self.service.jobs.get_payload())
+
+    def get_notify_value(self):
+        return self.service.jobs.get_payload()
+
+    def on_status_changed(self, status):
+        # Called from the job thread for every part, the scheduler coalesces them
+        self.value_changed()
+
+    def StartNotify(self):
+        self.start_notifying()
+
+    def StopNotify(self):
+        self.stop_notifying()
+
+    def ReadValue(self, options):
+        return self.get_status()
+
+    def WriteValue(self, value, options):
+        command = bytes(value).decode(errors='ignore').strip()
+        print(f"Received job command: {command}")
+        # "stop" stops every job, "stop <address>" only the job on that handler
+        if command.lower().startswith("stop"):
+            self.service.stopJob(command[4:].strip() or None)
+
+class ResultStreamCharacteristic(Characteristic):
+    """Streams per-part sort decisions as packed binary records, see resultStream.pack_result."""
+    UUID = "00000006-710e-4a5b-8d75-3e5b444bc3cf"
+    ACQUIRE_NOTIFY = True
+
+    def __init__(self, service):
+        self.notifying = False
+        self.flush_source = None
+        Characteristic.__init__(self, self.UUID, ["notify"], service)
+        self.batcher = ResultBatcher(self.on_packet, self.get_payload_size(),
+                                     RESULT_FLUSH_TIMEOUT / 1000)
+        service.jobs.add_result_listener(self.on_result)
+
+    def on_result(self, ID, bin, cycleTime, site):
+        # Called from the job thread, records are only packed while someone is listening
+        if self.notifying:
+            self.batcher.maxPayload = self.get_payload_size()  # The MTU may be learned after subscribing
+            self.batcher.add(ID, bin, cycleTime, site)
+
+    def on_packet(self, packet):
+        GObject.idle_add(self.send_packet, packet)
+
+    def send_packet(self, packet):
+        if self.notifying:
+            self.notify(packet)
+        return False
+
+    def flush_callback(self):
+        if self.notifying:
+            self.batcher.flush()
+            return True
+        self.flush_source = None
+        return False
+
+    def start_streaming(self):
+        self.batcher.maxPayload = self.get_payload_size()
+        if self.flush_source is not None:
+            GObject.source_remove(self.flush_source)
+        self.notifying = True
+        self.flush_source = self.add_timeout(RESULT_FLUSH_TIMEOUT, self.flush_callback)
+
+    def stop_streaming(self):
+        self.notifying = False
+        if self.flush_source is not None:
+            GObject.source_remove(self.flush_source)
+            self.flush_source = None
+
+    def StartNotify(self):
+        self.start_streaming()
+
+    def StopNotify(self):
+        self.stop_streaming()
+
+    def on_notify_acquired(self):
+        self.start_streaming()
+
+    def on_notify_released(self):
+        self.stop_streaming()
+
+class JobControlCharacteristic(Characteristic):
+    """Starts and stops jobs on a specific handler.
+       Writes are JSON commands such as {"cmd": "start", "address": "GPIB0::5::INSTR", "numParts": 1000, "profile": "fast"}
+       or {"cmd": "stop", "address": "GPIB0::5::INSTR"}. Starting uses the IDs last uploaded for that address.
+       Reading returns the result of the last command."""
+    UUID = "00000007-710e-4a5b-8d75-3e5b444bc3cf"
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.UUID, ["read", "write"], service)
+        self.last_result = b'{}'
+
+    def WriteValue(self, value, options):
+        try:
+            command = json.loads(bytes(value).decode('utf-8'))
+            cmd = command.get("cmd")
+            address = command.get("address")
+            if cmd == "start":
+                ok = self.service.sendJob(address, int(command.get("numParts", 30000)),
+                                          command.get("profile", HANDLER_PROFILE))
+            elif cmd == "stop":
+                self.service.stopJob(address)
+                ok = True
+            else:
+                raise ValueError(f"unknown command {cmd!r}")
+            result = {"cmd": cmd, "address": address, "ok": ok}
+        except Exception as e:
+            print(f"Job command failed: {e}")
+            result = {"ok": False, "error": str(e)}
+        self.last_result = json.dumps(result).encode('utf-8')
+
+    def ReadValue(self, options):
+        return dbus.ByteArray(self.last_result)
+
+class MetricsCharacteristic(Characteristic):
+    """Cycle phase histograms ([count, p50, p95, p99, max] in ms) and counters as compact JSON, see
+       metrics.get_payload. The value never exceeds 512 bytes; writing comma separated histogram names such as
+       "qrc,cycle" limits it to those, an empty write goes back to all that fit."""
+    UUID = "00000008-710e-4a5b-8d75-3e5b444bc3cf"
+    NOTIFY_MAX_INTERVAL = METRICS_NOTIFY_TIMEOUT  # No change events, checked periodically and sent if different
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.UUID, ["read", "notify", "write"], service)
+        self.selection = None
+
+    def get_metrics(self):
+        return dbus.ByteArray(metrics.get_payload(self.selection))
+
+    def get_notify_value(self):
+        return metrics.get_payload(self.selection)
+
+    def WriteValue(self, value, options):
+        names = [name.strip() for name in bytes(value).decode('utf-8', errors='ignore').split(',') if name.strip()]
+        unknown = set(names) - set(metrics.histogram_names())
+        if unknown:
+            raise InvalidArgsException(f"Unknown histograms: {', '.join(sorted(unknown))}")
+        self.selection = names or None
+        self.value_changed()
+
+    def StartNotify(self):
+        self.start_notifying()
+
+    def StopNotify(self):
+        self.stop_notifying()
+
+    def ReadValue(self, options):
+        return self.get_metrics()
+
+class LotResultsCharacteristic(Characteristic):
+    """Per-lot pass/fail counts, yield, duplicate IDs and throughput from the results database.
+       Reading returns the most recent lots; writing a JSON query such as {"lot": "GPIB0::5::INSTR/20260101-120000"},
+       {"id": "<2DID>"} or {"recent": 10} changes what the following reads return. The value never exceeds
+       512 bytes, and long reads at an offset continue the value built for the read at offset 0."""
+    UUID = "00000009-710e-4a5b-8d75-3e5b444bc3cf"
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.UUID, ["read", "write"], service)
+        self.query = None
+        self.value = b''
+
+    def WriteValue(self, value, options):
+        # Rejected queries leave the previous one in place and fail the write, so reads never raise
+        try:
+            self.query = validate_query(json.loads(bytes(value).decode('utf-8'))) or None
+        except ValueError as e:
+            print(f"Invalid results query: {e}")
+            raise FailedException(f"Invalid results query: {e}")
+
+    def ReadValue(self, options):
+        offset = int(options.get("offset", 0))
+        if offset == 0:
+            self.value = self.service.results.get_payload(self.query)
+        return dbus.ByteArray(self.value[offset:])
+
+class IDDeltaCharacteristic(Characteristic):
+    """Changes the accepted IDs of a running job without stopping it.
+       Writes are JSON such as {"address": "GPIB0::5::INSTR", "add": ["ID1", "ID2"], "remove": ["ID3"]}, applied
+       from the next sort cycle. Reading returns the outcome with the active ID set version, which is also
+       reported as idVersion in the job status. Malformed deltas fail the write with org.bluez.Error.Failed."""
+    UUID = "0000000a-710e-4a5b-8d75-3e5b444bc3cf"
+
+    def __init__(self, service):
+        Characteristic.__init__(self, self.UUID, ["read", "write"], service)
+        self.last_result = b'{}'
+
+    def WriteValue(self, value, options):
+        try:
+            delta = validate_delta(json.loads(bytes(value).decode('utf-8')))
+        except ValueError as e:
+            print(f"Invalid ID delta: {e}")
+            self.last_result = json.dumps({"ok": False, "error": str(e)}).encode('utf-8')
+            raise FailedException(f"Invalid ID delta: {e}")
+        try:
+            address = delta.get("address") or self.service.address
+            add, remove = delta.get("add", []), delta.get("remove", [])
+            version = self.service.jobs.apply_delta(address, add, remove)
+            result = {"address": address, "ok": version is not None, "version": version,
+                      "added": len(add), "removed": len(remove)}
+            if version is None:
+                result["error"] = "no job running"
+        except Exception as e:
+            print(f"ID delta failed: {e}")
+            result = {"ok": False, "error": str(e)}
+        print(f"ID delta: {result}")
+        self.last_result = json.dumps(result).encode('utf-8')
+
+    def ReadValue(self, options):
+        return dbus.ByteArray(self.last_result)
+
+if __name__ == "__main__":
+    configure_in_background()  # Advertise right away, the job path waits on the GPIB ready gate
+
+    app = Application()
+    app.add_service(BLEService(0))
+    app.register()
+
+    metrics.start_textfile_exporter()
+
+    adv = BLEAdvertisement(0)
+    adv.add_service_uuid(BLEService.BLE_SVC_UUID)
+    adv.register()
+
+    # systemd stops the service with SIGTERM, which skips atexit, so quit the main loop and flush below
+    if GLib is not None:
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGTERM, app.quit)
+    else:
+        signal.signal(signal.SIGTERM, lambda signum, frame: app.quit())
+
+    try:
+        app.run()
+    except KeyboardInterrupt:
+        app.quit()
+    finally:
+        get_logger().close()
+        get_results_db().close()
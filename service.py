@@ -19,13 +19,20 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import abc
+import socket
+import time
+import zlib
+
 import dbus
 import dbus.mainloop.glib
 import dbus.exceptions
+import dbus.service
 try:
-  from gi.repository import GObject
+  from gi.repository import GObject, GLib
 except ImportError:
     import gobject as GObject
+    GLib = None
 from bletools import BleTools
 
 BLUEZ_SERVICE_NAME = "org.bluez"
@@ -36,6 +43,10 @@ GATT_SERVICE_IFACE = "org.bluez.GattService1"
 GATT_CHRC_IFACE =    "org.bluez.GattCharacteristic1"
 GATT_DESC_IFACE =    "org.bluez.GattDescriptor1"
 
+CUD_UUID = "2901"  # Characteristic User Description
+DEFAULT_MTU = 23  # ATT MTU before the client negotiates a larger one
+ATT_HEADER_SIZE = 3
+
 class InvalidArgsException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
 
@@ -45,6 +56,48 @@ class NotSupportedException(dbus.exceptions.DBusException):
 class NotPermittedException(dbus.exceptions.DBusException):
     _dbus_error_name = "org.bluez.Error.NotPermitted"
 
+class FailedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.Failed"
+
+class GattObjectType(dbus.service.InterfaceType, abc.ABCMeta):
+    """Metaclass of dbus.service.Object combined with ABCMeta, so GattObject can declare abstract methods."""
+
+class GattObject(dbus.service.Object, metaclass=GattObjectType):
+    """Base of the GATT objects: properties are built once by build_properties() and served from a cache
+       marshal-ready as typed dbus.Dictionary values. Anything that changes a property must call invalidate(),
+       which also drops the Application's GetManagedObjects() table."""
+    INTERFACE = None
+
+    _properties = None
+
+    @abc.abstractmethod
+    def build_properties(self)->dict:
+        """{interface: {property: value}} of this object."""
+
+    def get_properties(self):
+        if self._properties is None:
+            self._properties = {interface: dbus.Dictionary(props, signature='sv')
+                                for interface, props in self.build_properties().items()}
+        return self._properties
+
+    def get_application(self):
+        return None
+
+    def invalidate(self):
+        self._properties = None
+        application = self.get_application()
+        if application is not None:
+            application.invalidate()
+
+    @dbus.service.method(DBUS_PROP_IFACE,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != self.INTERFACE:
+            raise InvalidArgsException()
+
+        return self.get_properties()[self.INTERFACE]
+
 class Application(dbus.service.Object):
     def __init__(self):
         dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -53,16 +106,19 @@ class Application(dbus.service.Object):
         self.path = "/"
         self.services = []
         self.next_index = 0
+        self._managed = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
+        service.application = self
         self.services.append(service)
+        self.invalidate()
 
-    @dbus.service.method(DBUS_OM_IFACE, out_signature = "a{oa{sa{sv}}}")
-    def GetManagedObjects(self):
+    def compile(self):
+        """Builds the object tree BlueZ asks for on registration and every client discovery."""
         response = {}
 
         for service in self.services:
@@ -74,7 +130,17 @@ class Application(dbus.service.Object):
                 for desc in descs:
                     response[desc.get_path()] = desc.get_properties()
 
-        return response
+        self._managed = dbus.Dictionary(response, signature='oa{sa{sv}}')
+        return self._managed
+
+    def invalidate(self):
+        self._managed = None
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature = "a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        if self._managed is None:
+            self.compile()
+        return self._managed
 
     def register_app_callback(self):
         print("GATT application registered")
@@ -83,6 +149,7 @@ class Application(dbus.service.Object):
         print("Failed to register application: " + str(error))
 
     def register(self):
+        self.compile()
         adapter = BleTools.find_adapter(self.bus)
 
         service_manager = dbus.Interface(
@@ -100,8 +167,9 @@ class Application(dbus.service.Object):
         print("\nGATT application terminated")
         self.mainloop.quit()
 
-class Service(dbus.service.Object):
+class Service(GattObject):
     PATH_BASE = "/org/bluez/example/service"
+    INTERFACE = GATT_SERVICE_IFACE
 
     def __init__(self, index, uuid, primary):
         self.bus = BleTools.get_bus()
@@ -110,9 +178,14 @@ class Service(dbus.service.Object):
         self.primary = primary
         self.characteristics = []
         self.next_index = 0
+        self.application = None
+        self.mtu = DEFAULT_MTU  # Last MTU BlueZ reported for any characteristic of this service
         dbus.service.Object.__init__(self, self.bus, self.path)
 
-    def get_properties(self):
+    def get_application(self):
+        return self.application
+
+    def build_properties(self):
         return {
                 GATT_SERVICE_IFACE: {
                         'UUID': self.uuid,
@@ -128,6 +201,7 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -147,19 +221,37 @@ class Service(dbus.service.Object):
 
         return idx
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_SERVICE_IFACE:
-            raise InvalidArgsException()
+def io_add_watch(fd, callback):
+    """Watches a file descriptor for input and hangups on the main loop."""
+    condition = GObject.IO_IN | GObject.IO_HUP | GObject.IO_ERR
+    if GLib is not None:
+        return GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT, condition, callback)
+    return GObject.io_add_watch(fd, condition, callback)
 
-        return self.get_properties()[GATT_SERVICE_IFACE]
-
-class Characteristic(dbus.service.Object):
+class Characteristic(GattObject):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Subclasses that set ACQUIRE_WRITE (with the "write-without-response" flag) or ACQUIRE_NOTIFY
+    (with the "notify" flag) let BlueZ hand over a socket instead of calling WriteValue or emitting
+    PropertiesChanged for every packet. Each datagram on an acquired write socket is passed to
+    on_acquired_write(), and notify() sends over the acquired notify socket when there is one.
+
+    DESCRIPTION declares a user description descriptor that is added with a precomputed value.
+
+    Subclasses that implement get_notify_value() can leave notifications to the scheduler: call
+    value_changed() from any thread when the value may have changed, and start_notifying()/stop_notifying()
+    from StartNotify/StopNotify. A value is only sent if its CRC differs from the last one sent, bursts
+    within NOTIFY_MIN_INTERVAL ms are coalesced into one notification, and values without a change event
+    are re-checked every NOTIFY_MAX_INTERVAL ms. Nothing runs while no client is subscribed.
     """
+    INTERFACE = GATT_CHRC_IFACE
+    ACQUIRE_WRITE = False
+    ACQUIRE_NOTIFY = False
+    DESCRIPTION = None
+    NOTIFY_MIN_INTERVAL = 0     # ms between two notifications
+    NOTIFY_MAX_INTERVAL = None  # ms between checks of get_notify_value(), None to rely on value_changed()
+
     def __init__(self, uuid, flags, service):
         index = service.get_next_index()
         self.path = service.path + '/char' + str(index)
@@ -169,25 +261,45 @@ class Characteristic(dbus.service.Object):
         self.flags = flags
         self.descriptors = []
         self.next_index = 0
+        self.mtu = DEFAULT_MTU
+        self.write_sock = None
+        self.notify_sock = None
+        self.notifying = False
+        self._last_crc = None
+        self._last_value = b''
+        self._last_sent = 0.0
+        self._flush_pending = False
+        self._flush_source = None
+        self._poll_source = None
         dbus.service.Object.__init__(self, self.bus, self.path)
-
-    def get_properties(self):
-        return {
-                GATT_CHRC_IFACE: {
-                        'Service': self.service.get_path(),
-                        'UUID': self.uuid,
-                        'Flags': self.flags,
-                        'Descriptors': dbus.Array(
-                                self.get_descriptor_paths(),
-                                signature='o')
-                }
+        if self.DESCRIPTION is not None:
+            self.add_descriptor(StaticDescriptor(self, CUD_UUID, self.DESCRIPTION))
+
+    def get_application(self):
+        return self.service.get_application()
+
+    def build_properties(self):
+        properties = {
+                'Service': self.service.get_path(),
+                'UUID': self.uuid,
+                'Flags': self.flags,
+                'Descriptors': dbus.Array(
+                        self.get_descriptor_paths(),
+                        signature='o')
         }
+        # The presence of these properties tells BlueZ that Acquire* is supported
+        if self.ACQUIRE_WRITE:
+            properties['WriteAcquired'] = dbus.Boolean(self.write_sock is not None)
+        if self.ACQUIRE_NOTIFY:
+            properties['NotifyAcquired'] = dbus.Boolean(self.notify_sock is not None)
+        return {GATT_CHRC_IFACE: properties}
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -198,15 +310,6 @@ class Characteristic(dbus.service.Object):
     def get_descriptors(self):
         return self.descriptors
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_CHRC_IFACE:
-            raise InvalidArgsException()
-
-        return self.get_properties()[GATT_CHRC_IFACE]
-
     @dbus.service.method(GATT_CHRC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
@@ -246,10 +349,194 @@ class Characteristic(dbus.service.Object):
         return idx
 
     def add_timeout(self, timeout, callback):
-        GObject.timeout_add(timeout, callback)
+        return GObject.timeout_add(timeout, callback)
+
+    def update_mtu(self, options):
+        """Records the negotiated ATT MTU that BlueZ passes in the options of reads, writes and acquires.
+           The service keeps it too, so a characteristic that is only subscribed with StartNotify, which
+           carries no options, still learns the MTU from the client's other requests."""
+        if options and 'mtu' in options:
+            self.mtu = int(options['mtu'])
+            self.service.mtu = self.mtu
+        return self.mtu
+
+    def get_payload_size(self):
+        """Largest value that fits in a single notification or write without response."""
+        mtu = self.mtu if self.notify_sock is not None or self.write_sock is not None else self.service.mtu
+        return mtu - ATT_HEADER_SIZE
+
+    def _acquire(self, options):
+        mtu = self.update_mtu(options)
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        local.setblocking(False)
+        fd = dbus.types.UnixFd(remote)  # Duplicates the descriptor for BlueZ
+        remote.close()
+        return local, fd, dbus.UInt16(mtu)
 
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireWrite(self, options):
+        if not self.ACQUIRE_WRITE or 'write-without-response' not in self.flags:
+            raise NotSupportedException()
+        self.release_write()
+        self.write_sock, fd, mtu = self._acquire(options)
+        self.invalidate()  # WriteAcquired changed
+        io_add_watch(self.write_sock.fileno(), self._on_write_sock)
+        print(f"{self.uuid}: write acquired, MTU {mtu}")
+        return fd, mtu
+
+    @dbus.service.method(GATT_CHRC_IFACE,
+                         in_signature='a{sv}',
+                         out_signature='hq')
+    def AcquireNotify(self, options):
+        if not self.ACQUIRE_NOTIFY or 'notify' not in self.flags:
+            raise NotSupportedException()
+        self.release_notify()
+        self.notify_sock, fd, mtu = self._acquire(options)
+        self.invalidate()  # NotifyAcquired changed
+        io_add_watch(self.notify_sock.fileno(), self._on_notify_sock)
+        print(f"{self.uuid}: notify acquired, MTU {mtu}")
+        self.on_notify_acquired()
+        return fd, mtu
+
+    def _on_write_sock(self, fd, condition):
+        sock = self.write_sock
+        if sock is None or sock.fileno() != fd:
+            return False
+        if condition & GObject.IO_IN:
+            while True:
+                try:
+                    data = sock.recv(self.mtu)
+                except BlockingIOError:
+                    break
+                except OSError:
+                    data = b''
+                if not data:
+                    condition |= GObject.IO_HUP
+                    break
+                try:
+                    self.on_acquired_write(data)
+                except Exception as e:
+                    print(f"{self.uuid}: acquired write failed: {e}")
+        if condition & (GObject.IO_HUP | GObject.IO_ERR):
+            self.release_write()
+            return False
+        return True
+
+    def _on_notify_sock(self, fd, condition):
+        if self.notify_sock is None or self.notify_sock.fileno() != fd:
+            return False
+        if condition & (GObject.IO_HUP | GObject.IO_ERR):
+            self.release_notify()
+            return False
+        return True
+
+    def release_write(self):
+        if self.write_sock is not None:
+            self.write_sock.close()
+            self.write_sock = None
+            self.invalidate()
+
+    def release_notify(self):
+        if self.notify_sock is not None:
+            self.notify_sock.close()
+            self.notify_sock = None
+            self.invalidate()
+            self.on_notify_released()
+
+    def on_acquired_write(self, data):
+        """Called with each datagram written through an acquired socket. Defaults to WriteValue()."""
+        self.WriteValue(data, {'mtu': self.mtu, 'type': 'command'})
+
+    def on_notify_acquired(self):
+        """Called when a client subscribes through AcquireNotify."""
+        pass
+
+    def on_notify_released(self):
+        """Called when the client of an acquired notify socket goes away."""
+        pass
+
+    def notify(self, value):
+        """Sends a value to subscribers, over the acquired socket if there is one."""
+        self._last_value = bytes(value)
+        if self.notify_sock is not None:
+            try:
+                self.notify_sock.send(bytes(value))
+                return
+            except BlockingIOError:
+                return  # Socket buffer full, drop like the radio would
+            except OSError:
+                self.release_notify()
+        self.PropertiesChanged(GATT_CHRC_IFACE, {"Value": dbus.ByteArray(bytes(value))}, [])
+
+    def get_notify_value(self):
+        """Current value for the notification scheduler, as bytes. Defaults to the last value sent with notify(),
+           so a characteristic that pushes its values itself never notifies twice."""
+        return self._last_value
+
+    def start_notifying(self):
+        """Subscribes: sends the current value and starts the periodic check if there is one."""
+        if self.notifying:
+            return
+        self.notifying = True
+        self._last_crc = None  # A new subscriber always gets the current value
+        self._flush()
+        if self.NOTIFY_MAX_INTERVAL is not None:
+            self._poll_source = GObject.timeout_add(self.NOTIFY_MAX_INTERVAL, self._poll)
+
+    def stop_notifying(self):
+        """Unsubscribes and removes every pending timer, so nothing is computed until the next subscription."""
+        self.notifying = False
+        for source in (self._poll_source, self._flush_source):
+            if source is not None:
+                GObject.source_remove(source)
+        self._poll_source = self._flush_source = None
+
+    def value_changed(self):
+        """Schedules a check of get_notify_value(), safe to call from any thread and as often as needed."""
+        if self.notifying and not self._flush_pending:
+            self._flush_pending = True
+            GObject.idle_add(self._on_value_changed)
+
+    def _on_value_changed(self):
+        self._flush_pending = False
+        if self.notifying and self._flush_source is None:
+            wait = self._last_sent + self.NOTIFY_MIN_INTERVAL / 1000 - time.monotonic()
+            if wait > 0:
+                # Too soon after the last notification, everything until then goes out as one
+                self._flush_source = GObject.timeout_add(int(wait * 1000) + 1, self._delayed_flush)
+            else:
+                self._flush()
+        return False
+
+    def _delayed_flush(self):
+        self._flush_source = None
+        self._flush()
+        return False
+
+    def _poll(self):
+        if not self.notifying:
+            self._poll_source = None
+            return False
+        self._on_value_changed()
+        return True
+
+    def _flush(self):
+        if not self.notifying:
+            return
+        value = bytes(self.get_notify_value())
+        crc = zlib.crc32(value)
+        if crc == self._last_crc:
+            return
+        self._last_crc = crc
+        self._last_sent = time.monotonic()
+        self.notify(value)
+
+
+class Descriptor(GattObject):
+    INTERFACE = GATT_DESC_IFACE
 
-class Descriptor(dbus.service.Object):
     def __init__(self, uuid, flags, characteristic):
         index = characteristic.get_next_index()
         self.path = characteristic.path + '/desc' + str(index)
@@ -259,7 +546,10 @@ class Descriptor(dbus.service.Object):
         self.bus = characteristic.get_bus()
         dbus.service.Object.__init__(self, self.bus, self.path)
 
-    def get_properties(self):
+    def get_application(self):
+        return self.chrc.get_application()
+
+    def build_properties(self):
         return {
                 GATT_DESC_IFACE: {
                         'Characteristic': self.chrc.get_path(),
@@ -271,15 +561,6 @@ class Descriptor(dbus.service.Object):
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
-    @dbus.service.method(DBUS_PROP_IFACE,
-                         in_signature='s',
-                         out_signature='a{sv}')
-    def GetAll(self, interface):
-        if interface != GATT_DESC_IFACE:
-            raise InvalidArgsException()
-
-        return self.get_properties()[GATT_DESC_IFACE]
-
     @dbus.service.method(GATT_DESC_IFACE,
                         in_signature='a{sv}',
                         out_signature='ay')
@@ -292,6 +573,19 @@ class Descriptor(dbus.service.Object):
         print('Default WriteValue called, returning error')
         raise NotSupportedException()
 
+class StaticDescriptor(Descriptor):
+    """Read-only descriptor with a constant value, encoded once into a dbus.ByteArray.
+       Subclasses can declare UUID and VALUE instead of passing them."""
+    UUID = CUD_UUID
+    VALUE = ""
+
+    def __init__(self, characteristic, uuid=None, value=None):
+        value = self.VALUE if value is None else value
+        self.value = dbus.ByteArray(value.encode() if isinstance(value, str) else bytes(value))
+        Descriptor.__init__(self, uuid or self.UUID, ["read"], characteristic)
+
+    def ReadValue(self, options):
+        return self.value
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
     CUD_UUID = '2901'
@@ -0,0 +1,68 @@
+import threading
+
+from gpibBus import resource_manager
+
+class SessionPool:
+    """Keeps one open VISA session per address on a shared ResourceManager, so jobs and scans do not pay the
+       open cost again. A job leases its address for as long as it runs; scans leave leased addresses alone
+       and report the identity last seen there instead."""
+    def __init__(self, rm=None):
+        self._rm = rm
+        self._sessions = {}
+        self._leased = set()
+        self.idn = {}  # address -> last *IDN? response
+        self._lock = threading.Lock()
+
+    @property
+    def rm(self):
+        if self._rm is None:
+            self._rm = resource_manager()
+        return self._rm
+
+    def open(self, address: str):
+        """Returns the session for address, opening it on first use."""
+        with self._lock:
+            session = self._sessions.get(address)
+            if session is None:
+                session = self.rm.open_resource(address)
+                self._sessions[address] = session
+            return session
+
+    def lease(self, address: str):
+        """Opens the session for a job and marks the address as in use."""
+        session = self.open(address)
+        with self._lock:
+            self._leased.add(address)
+        return session
+
+    def release(self, address: str):
+        with self._lock:
+            self._leased.discard(address)
+
+    def leased(self, address: str)->bool:
+        return address in self._leased
+
+    def discard(self, address: str):
+        """Closes a session that may be in a bad state, the next open() starts fresh."""
+        with self._lock:
+            session = self._sessions.pop(address, None)
+        if session is not None:
+            try:
+                session.close()
+            except Exception:
+                pass
+
+    def close_all(self):
+        for address in list(self._sessions):
+            self.discard(address)
+
+_pool = None
+_poolLock = threading.Lock()
+
+def get_pool()->SessionPool:
+    """The process-wide pool on gpibBus.resource_manager()."""
+    global _pool
+    with _poolLock:
+        if _pool is None:
+            _pool = SessionPool()
+        return _pool
@@ -0,0 +1,168 @@
+import itertools
+import threading
+import time
+
+class SimHandler:
+    """Simulated SYNAX handler that behaves like the pyvisa resource configure() and sortCycle() talk to.
+       It answers the CONFIGURE/QRM?/REQUEST,CHECKEMPTY/FULLSITES?/QRC?/PAUSE/RESUME/BINON/ECHOOK exchange,
+       raises SRQ 0x44 for the empty socket check and SRQ 0x41 for every index, and 0x48 once the lot is done.
+       writeLatency, readLatency and pollLatency are the bus cost of each transaction, indexTime is the
+       mechanical time between ECHOOK and the next index, and ids supplies the 2DIDs placed in the sites."""
+    def __init__(self, ids=None, sites: int = 1, parts: int = None, writeLatency: float = 0.001,
+                 readLatency: float = 0.002, pollLatency: float = 0.0005, indexTime: float = 0.0,
+                 checkEmptyTime: float = 0.0, idn: str = "SYNAX, S9, ID:SIM0001, s/n:00000, MPC:1.00.0 / MCC:1.00.0"):
+        self.ids = iter(ids) if ids is not None else (f"SIM{i:08d}" for i in itertools.count(1))
+        self.sites = sites
+        self.partsLeft = parts
+        self.writeLatency = writeLatency
+        self.readLatency = readLatency
+        self.pollLatency = pollLatency
+        self.indexTime = indexTime
+        self.checkEmptyTime = checkEmptyTime
+        self.idn = idn
+        self.timeout = 2000
+        self.write_termination = '\r\n'
+        self.read_termination = '\r\n'
+        self.transactions = 0
+        self.binned = []          # (ID, bin) for every part that left a site
+        self._responses = []
+        self._site_ids = {}       # site -> ID of the current index
+        self._status = 0
+        self._readyAt = None      # When the pending status byte becomes visible
+        self._pending = 0
+        self._changed = threading.Condition()
+
+    def _bus(self, latency: float):
+        self.transactions += 1
+        if latency:
+            time.sleep(latency)
+
+    def _raise_srq(self, status: int, delay: float):
+        with self._changed:
+            self._pending = status
+            self._readyAt = time.monotonic() + delay
+            self._changed.notify_all()
+
+    def _load_index(self):
+        """Places the next IDs into the sites and raises SRQ 0x41, or 0x48 if the lot is finished."""
+        self._site_ids = {}
+        for site in range(1, self.sites + 1):
+            if self.partsLeft is not None and self.partsLeft <= 0:
+                break
+            ID = next(self.ids, None)
+            if ID is None:
+                break
+            self._site_ids[site] = ID
+            if self.partsLeft is not None:
+                self.partsLeft -= 1
+        self._raise_srq(0x41 if self._site_ids else 0x48, self.indexTime)
+
+    def write(self, msg: str):
+        self._bus(self.writeLatency)
+        if msg.startswith("CONFIGURE,"):
+            self._responses.append(msg + ":OK")
+        elif msg == "QRM?":
+            self._responses.append("QRM:1")
+        elif msg == "REQUEST,CHECKEMPTY":
+            self._raise_srq(0x44, self.checkEmptyTime)
+            self._responses.append("CHECKEMPTY")
+        elif msg == "FULLSITES?":
+            bitmap = sum(1 << (site - 1) for site in self._site_ids)
+            self._responses.append(f"FULLSITES {bitmap:08X}")
+        elif msg == "QRC?":
+            fields = [self._site_ids.get(site, "") for site in range(1, self.sites + 1)]
+            self._responses.append("QRC:" + ",".join(fields) + ",")
+        elif msg.startswith("BINON:"):
+            digits = msg[6:].replace(',', '')
+            for site, ID in self._site_ids.items():
+                self.binned.append((ID, int(digits[-site], 16)))
+            self._responses.append(msg)
+        elif msg == "ECHOOK":
+            self._load_index()
+        elif msg == "SRQKIND?":
+            self._responses.append("SRQKIND 8" if self._pending == 0x48 else "SRQKIND 2")
+        elif msg == "*IDN?":
+            self._responses.append(self.idn)
+        # PAUSE and RESUME have no response
+
+    def read(self)->str:
+        self._bus(self.readLatency)
+        if not self._responses:
+            raise TimeoutError("Simulated handler has nothing to read")
+        return self._responses.pop(0)
+
+    def query(self, msg: str)->str:
+        self.write(msg)
+        return self.read()
+
+    def read_stb(self)->int:
+        """Serial poll, returns and clears the pending service request once it is due."""
+        self._bus(self.pollLatency)
+        with self._changed:
+            if self._readyAt is not None and time.monotonic() >= self._readyAt:
+                status = self._pending
+                self._readyAt = None
+                return status
+        return 0
+
+    def clear(self):
+        """Device clear, drops unread responses and the pending service request."""
+        self._bus(self.writeLatency)
+        self._responses = []
+        with self._changed:
+            self._readyAt = None
+            self._changed.notify_all()
+
+    def enable_event(self, eventType, mechanism):
+        pass
+
+    def wait_on_event(self, eventType, timeout: int):
+        """Blocks until a service request is due, like a VISA service request event."""
+        deadline = time.monotonic() + timeout / 1000
+        with self._changed:
+            while True:
+                now = time.monotonic()
+                if self._readyAt is not None and now >= self._readyAt:
+                    return
+                until = deadline if self._readyAt is None else min(deadline, self._readyAt)
+                if now >= deadline:
+                    raise TimeoutError("Timed out waiting for simulated SRQ")
+                self._changed.wait(until - now)
+
+    def close(self):
+        pass
+
+NO_LISTENER_TIME = 0.001  # Seconds until a write to an empty address fails the handshake
+
+class SimAbsent:
+    """An empty address. Writes fail quickly for lack of listeners like VI_ERROR_NLISTENERS,
+       reads and queries time out after the resource timeout."""
+    def __init__(self):
+        self.timeout = 2000
+
+    def write(self, msg: str):
+        time.sleep(NO_LISTENER_TIME)
+        raise ConnectionError("No listeners")
+
+    def read(self)->str:
+        time.sleep(self.timeout / 1000)
+        raise TimeoutError("No listener")
+
+    def query(self, msg: str)->str:
+        time.sleep(self.timeout / 1000)
+        raise TimeoutError("No listener")
+
+    def close(self):
+        pass
+
+class SimResourceManager:
+    """Stands in for pyvisa.ResourceManager, handing out the simulated instruments by address."""
+    def __init__(self, instruments: dict):
+        self.instruments = instruments
+
+    def list_resources(self)->tuple:
+        return tuple(self.instruments)
+
+    def open_resource(self, address: str):
+        instrument = self.instruments.get(address)
+        return instrument if instrument is not None else SimAbsent()
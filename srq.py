@@ -0,0 +1,320 @@
+import queue
+import threading
+import time
+import weakref
+
+from gpibBus import BUS_LOCK
+
+RQS = 0x40  # Status byte bit set by a device requesting service
+
+# linux-gpib ibsta bits and timeout codes used by ibwait
+IBSTA_TIMO = 0x4000
+IBSTA_SRQI = 0x1000
+GPIB_T100MS = 9
+BUS_SRQ = 0x2000  # linux-gpib iblines bit for the SRQ line
+VALID_SRQ = 0x20
+
+EVENT = "event"    # VISA service request events
+IBWAIT = "ibwait"  # linux-gpib ibwait on the board's SRQI line
+POLL = "poll"      # adaptive read_stb polling
+AUTO = "auto"      # first of event, ibwait, poll that works
+
+MIN_POLL_INTERVAL = 0.002
+MAX_POLL_INTERVAL = 0.1
+EVENT_SLICE = 0.25  # Seconds per wait so a deadline is noticed even if events are missed
+
+class SrqWaiter:
+    """Waits for a device to request service with a given status byte.
+       Prefers blocking on a VISA service request event or on linux-gpib's ibwait, and falls back to
+       polling read_stb() on an interval that adapts to how long recent SRQs with the same status byte took to arrive."""
+    def __init__(self, instrument, mode: str = AUTO, board: int = 0,
+                 minInterval: float = MIN_POLL_INTERVAL, maxInterval: float = MAX_POLL_INTERVAL):
+        self.instrument = instrument
+        self.board = board
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.expectedWait = {}  # status byte -> moving average of how long its SRQ took to show, in seconds
+        self.mode = self._select_mode(mode)
+        print(f"SRQ wait mode: {self.mode}")
+
+    def _select_mode(self, mode: str)->str:
+        if mode in (AUTO, EVENT) and self._enable_events():
+            return EVENT
+        if mode in (AUTO, IBWAIT) and self._enable_ibwait():
+            return IBWAIT
+        if mode != AUTO and mode != POLL:
+            print(f"SRQ wait mode '{mode}' unavailable, falling back to polling.")
+        return POLL
+
+    def _enable_events(self)->bool:
+        try:
+            from pyvisa import constants
+            self.instrument.enable_event(constants.EventType.service_request,
+                                         constants.EventMechanism.queue)
+            self._constants = constants
+            return True
+        except Exception:
+            return False
+
+    def _enable_ibwait(self)->bool:
+        try:
+            import gpib
+            gpib.timeout(self.board, GPIB_T100MS)
+            self._gpib = gpib
+            return True
+        except Exception:
+            return False
+
+    def wait(self, expected, timeout: float = None, stopEvent=None)->int:
+        """Blocks until the status byte equals `expected`, or one of them if it is a tuple, and returns it.
+           Returns None as soon as stopEvent is set, and raises TimeoutError if nothing arrives within
+           `timeout` seconds."""
+        expected = _expected(expected)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if self.mode == EVENT:
+            status = self._wait_event(expected, deadline, stopEvent)
+        elif self.mode == IBWAIT:
+            status = self._wait_ibwait(expected, deadline, stopEvent)
+        else:
+            status = self._wait_poll(expected, deadline, stopEvent)
+        return status
+
+    def _read_stb(self)->int:
+        with BUS_LOCK:
+            return self.instrument.read_stb()
+
+    def _remaining(self, deadline)->float:
+        if deadline is None:
+            return EVENT_SLICE
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError("Timed out waiting for SRQ")
+        return min(remaining, EVENT_SLICE)
+
+    def _check(self, status: int, expected: tuple)->bool:
+        if status & RQS:
+            if status in expected:
+                return True
+            print(f"SRQ asserted, but not {_format(expected)} (status byte = {hex(status)}). Waiting...")
+        return False
+
+    def _wait_event(self, expected: tuple, deadline, stopEvent)->int:
+        constants = self._constants
+        while True:
+            # The event may have been queued before we started waiting, so always poll once
+            status = self._read_stb()
+            if self._check(status, expected):
+                return status
+            if _stopped(stopEvent):
+                return None
+            try:
+                self.instrument.wait_on_event(constants.EventType.service_request,
+                                              int(self._remaining(deadline) * 1000))
+            except Exception:
+                pass  # Timed out on this slice, the deadline is checked on the next pass
+
+    def _wait_ibwait(self, expected: tuple, deadline, stopEvent)->int:
+        gpib = self._gpib
+        while True:
+            status = self._read_stb()
+            if self._check(status, expected):
+                return status
+            if _stopped(stopEvent):
+                return None
+            self._remaining(deadline)
+            gpib.wait(self.board, IBSTA_SRQI | IBSTA_TIMO)
+
+    def _wait_poll(self, expected: tuple, deadline, stopEvent)->int:
+        start = time.monotonic()
+        interval = self.minInterval
+        expectedWait = self.expectedWait.get(expected)
+        if expectedWait is not None:
+            # Sleep through part of the typical wait, then poll quickly around the expected arrival.
+            # Capped, so an unusually long wait (operator pause, slow empty socket check) costs one poll interval.
+            head = min(expectedWait * 0.5, self.maxInterval)
+            if deadline is not None:
+                head = min(head, max(0.0, deadline - time.monotonic()))
+            if _sleep(head, stopEvent):
+                return None
+            interval = max(self.minInterval, min(self.maxInterval, expectedWait / 16))
+        missed = None  # When a poll last came back without the SRQ
+        while True:
+            status = self._read_stb()
+            if self._check(status, expected):
+                # Learn from the last poll that missed it, the forced sleep says nothing about the arrival
+                self._record(expected, 0.0 if missed is None else missed - start)
+                return status
+            missed = time.monotonic()
+            if deadline is not None and missed + interval > deadline:
+                raise TimeoutError("Timed out waiting for SRQ")
+            if _sleep(interval, stopEvent):
+                return None
+            interval = min(self.maxInterval, interval * 1.5)  # Back off the longer it takes
+
+    def _record(self, expected: tuple, elapsed: float):
+        previous = self.expectedWait.get(expected)
+        self.expectedWait[expected] = elapsed if previous is None else previous + 0.2 * (elapsed - previous)
+
+class SrqDispatcher:
+    """Routes service requests on a bus shared by several handlers.
+       While only one handler is registered its waiter keeps using that handler's own SrqWaiter (VISA events,
+       ibwait or adaptive polling). From two handlers on, one thread watches the SRQ line, blocking in ibwait
+       on SRQI when linux-gpib is available and otherwise polling on an interval that backs off while nothing
+       arrives, serial polls the handlers that are waiting to find who asserted it and queues the status byte
+       for that handler's DispatchedSrqWaiter."""
+    def __init__(self, board: int = 0, minInterval: float = MIN_POLL_INTERVAL, maxInterval: float = MAX_POLL_INTERVAL):
+        self.board = board
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self._handlers = {}  # address -> DispatchedSrqWaiter
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        try:
+            import gpib
+            gpib.lines(self.board)
+            gpib.timeout(self.board, GPIB_T100MS)
+            self._gpib = gpib
+        except Exception:
+            self._gpib = None
+
+    def register(self, address: str, waiter: SrqWaiter)->'DispatchedSrqWaiter':
+        """Wraps the handler's own waiter, which stays in use until a second handler is registered."""
+        dispatched = DispatchedSrqWaiter(self, waiter)
+        with self._lock:
+            self._handlers[address] = dispatched
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return dispatched
+
+    def unregister(self, address: str):
+        with self._lock:
+            dispatched = self._handlers.pop(address, None)
+        if dispatched is not None and _waiters.get(dispatched.instrument) is dispatched:
+            _waiters[dispatched.instrument] = dispatched.waiter
+
+    def shared(self, dispatched: 'DispatchedSrqWaiter')->bool:
+        """True while the bus is shared, so dispatched has to wait for the dispatcher thread."""
+        with self._lock:
+            if len(self._handlers) < 2 or dispatched not in self._handlers.values():
+                return False
+            dispatched.waiting = True
+        self._wake.set()
+        return True
+
+    def _waiting(self)->list:
+        with self._lock:
+            return [dispatched for dispatched in self._handlers.values() if dispatched.waiting]
+
+    def _srq_asserted(self)->bool:
+        if self._gpib is None:
+            return True  # No way to look at the line, serial poll everyone who waits
+        gpib = self._gpib
+        gpib.wait(self.board, IBSTA_SRQI | IBSTA_TIMO)  # Returns at once if SRQ is already asserted
+        lines = gpib.lines(self.board)
+        return not (lines & VALID_SRQ) or bool(lines & BUS_SRQ)
+
+    def _run(self):
+        interval = self.minInterval
+        while True:
+            waiting = self._waiting()
+            if not waiting:
+                self._wake.wait()
+                self._wake.clear()
+                interval = self.minInterval
+                continue
+            if not self._srq_asserted():
+                continue  # ibwait timed out, nobody asked for service
+            answered = False
+            for dispatched in waiting:
+                try:
+                    with BUS_LOCK:
+                        status = dispatched.instrument.read_stb()
+                except Exception as e:
+                    print(f"Serial poll failed: {e}")
+                    continue
+                if status & RQS:
+                    dispatched.put(status)
+                    answered = True
+            if answered:
+                interval = self.minInterval
+            else:
+                # Polling blind, or the line is held by a handler that is not waiting yet
+                self._wake.wait(interval)
+                self._wake.clear()
+                interval = min(self.maxInterval, interval * 1.5)
+
+class DispatchedSrqWaiter:
+    """SrqWaiter counterpart for a handler registered with an SrqDispatcher. Waits through the handler's own
+       SrqWaiter while it is alone on the bus, and on status bytes queued by the dispatcher once it is shared."""
+    def __init__(self, dispatcher: SrqDispatcher, waiter: SrqWaiter):
+        self.dispatcher = dispatcher
+        self.waiter = waiter
+        self.instrument = waiter.instrument
+        self.waiting = False
+        self._queue = queue.SimpleQueue()
+
+    @property
+    def mode(self)->str:
+        return "dispatch" if len(self.dispatcher._handlers) > 1 else self.waiter.mode
+
+    def put(self, status: int):
+        self._queue.put(status)
+
+    def wait(self, expected, timeout: float = None, stopEvent=None)->int:
+        if not self.dispatcher.shared(self):
+            return self.waiter.wait(expected, timeout, stopEvent)
+        try:
+            return self._wait_queue(_expected(expected), timeout, stopEvent)
+        finally:
+            self.waiting = False
+
+    def _wait_queue(self, expected: tuple, timeout: float, stopEvent)->int:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if _stopped(stopEvent):
+                return None
+            remaining = EVENT_SLICE if deadline is None else min(deadline - time.monotonic(), EVENT_SLICE)
+            if remaining <= 0:
+                raise TimeoutError("Timed out waiting for SRQ")
+            try:
+                status = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                continue  # End of a slice, the stop request and the deadline are checked on the next pass
+            if status in expected:
+                return status
+            print(f"SRQ asserted, but not {_format(expected)} (status byte = {hex(status)}). Waiting...")
+
+def _expected(expected)->tuple:
+    return (expected,) if isinstance(expected, int) else tuple(expected)
+
+def _format(expected: tuple)->str:
+    return " or ".join(hex(status) for status in expected)
+
+def _stopped(stopEvent)->bool:
+    return stopEvent is not None and stopEvent.is_set()
+
+def _sleep(seconds: float, stopEvent)->bool:
+    """Sleeps, cut short by stopEvent. Returns True if a stop was requested."""
+    if stopEvent is None:
+        time.sleep(seconds)
+        return False
+    return stopEvent.wait(seconds)
+
+_waiters = weakref.WeakKeyDictionary()
+
+def srq_waiter(instrument, mode: str = AUTO)->SrqWaiter:
+    """Returns the SrqWaiter for an instrument, creating it on first use so events are only enabled once."""
+    waiter = _waiters.get(instrument)
+    if waiter is None:
+        waiter = SrqWaiter(instrument, mode)
+        _waiters[instrument] = waiter
+    return waiter
+
+def attach_dispatcher(instrument, address: str, dispatcher: SrqDispatcher, mode: str = AUTO):
+    """Makes srq_waiter() hand out a waiter that switches to the dispatcher while the bus is shared."""
+    waiter = srq_waiter(instrument, mode)
+    if isinstance(waiter, DispatchedSrqWaiter):
+        waiter = waiter.waiter  # Pooled session left attached by an earlier job
+    _waiters[instrument] = dispatcher.register(address, waiter)
@@ -0,0 +1,158 @@
+import abc
+import asyncio
+import time
+
+from gpibBus import BUS_LOCK
+from srq import RQS, srq_waiter
+from handlerFunctions import WRITE, READ, write_log
+
+class Transport(abc.ABC):
+    """Asynchronous message-based connection to one GPIB instrument.
+       run() drives the same protocol steps as the synchronous sort loop (handlerFunctions.configureSteps(),
+       sortCycleSteps()) over these coroutines, so asyncSort runs unchanged over pyvisa/linux-gpib or over an
+       AR488 USB-serial adapter, and several instruments can be driven from one event loop."""
+    @abc.abstractmethod
+    async def write(self, msg: str):
+        ...
+
+    @abc.abstractmethod
+    async def read(self)->str:
+        ...
+
+    async def query(self, msg: str)->str:
+        await self.write(msg)
+        return await self.read()
+
+    @abc.abstractmethod
+    async def read_stb(self)->int:
+        """Serial poll."""
+
+    @abc.abstractmethod
+    async def wait_srq(self, expected, timeout: float = None, stopEvent=None)->int:
+        """Waits until the instrument requests service with the expected status byte, or one of them if
+           expected is a tuple. Returns None as soon as stopEvent is set."""
+
+    async def close(self):
+        pass
+
+    async def run(self, steps, stopEvent=None):
+        """Runs protocol steps on this transport and returns the generator's return value, the asynchronous
+           counterpart of handlerFunctions.runSteps()."""
+        result = None
+        try:
+            while True:
+                step = steps.send(result)
+                if step[0] == WRITE:
+                    await self.write(step[1])
+                    write_log(f"-> {step[1]}")
+                    result = None
+                elif step[0] == READ:
+                    result = await self.read()
+                    write_log(f"<- {result}")
+                else:
+                    result = await self.wait_srq(step[1], timeout=step[2], stopEvent=stopEvent)
+        except StopIteration as stop:
+            return stop.value
+
+class PyvisaTransport(Transport):
+    """Transport over a pyvisa resource. pyvisa calls block, so they run in the loop's default executor
+       under the bus lock, and SRQ waits use the same SrqWaiter as the synchronous sort loop."""
+    def __init__(self, instrument, srqMode: str = "auto"):
+        self.instrument = instrument
+        self.srqMode = srqMode
+
+    async def _call(self, function, *args):
+        def locked():
+            with BUS_LOCK:
+                return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, locked)
+
+    async def write(self, msg: str):
+        await self._call(self.instrument.write, msg)
+
+    async def read(self)->str:
+        return await self._call(self.instrument.read)
+
+    async def read_stb(self)->int:
+        return await self._call(self.instrument.read_stb)
+
+    async def wait_srq(self, expected, timeout: float = None, stopEvent=None)->int:
+        waiter = srq_waiter(self.instrument, self.srqMode)
+        # SrqWaiter takes the bus lock per serial poll itself, so other instruments keep running meanwhile
+        return await asyncio.get_running_loop().run_in_executor(None, waiter.wait, expected, timeout, stopEvent)
+
+    async def close(self):
+        await self._call(self.instrument.close)
+
+class AR488Transport(Transport):
+    """Transport to one instrument address behind an AR488 adapter, using ++read, ++spoll and ++srq.
+       It runs over the shared AR488Monitor.get_connection(), the same connection the AR488 device scan uses,
+       so the port is opened and the board reset once. Connection calls block, so they run in the loop's
+       default executor, and the connection lock keeps every exchange together."""
+    def __init__(self, address: int, connection=None, timeout: float = 2.0,
+                 minInterval: float = 0.002, maxInterval: float = 0.05):
+        if connection is None:
+            from AR488Monitor import get_connection  # pyserial is only needed with an adapter
+            connection = get_connection()
+        self.connection = connection
+        self.address = int(address)
+        self.timeout = timeout
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+
+    @classmethod
+    def for_address(cls, address: str)->'AR488Transport':
+        """Transport for a VISA style address such as GPIB0::5::INSTR, see JobManager.set_transport()."""
+        return cls(address.split("::")[1])
+
+    async def _call(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def _query(self, command: str, address=None)->str:
+        response = await self._call(self.connection.query, command, address, self.timeout)
+        if response is None:
+            raise TimeoutError(f"No response to {command.strip()} from GPIB address {self.address}")
+        return response
+
+    async def write(self, msg: str):
+        await self._call(self.connection.write, _escape(msg), self.address)
+
+    async def read(self)->str:
+        response = await self._call(self.connection.read, self.address, self.timeout)
+        if response is None:
+            raise TimeoutError(f"No response from GPIB address {self.address}")
+        return response
+
+    async def query(self, msg: str)->str:
+        return await self._query(_escape(msg), self.address)  # Write and ++read under one lock
+
+    async def read_stb(self)->int:
+        return int(await self._query(f"++spoll {self.address}"))
+
+    async def _srq_line(self)->bool:
+        return (await self._query("++srq")) == "1"
+
+    async def wait_srq(self, expected, timeout: float = None, stopEvent=None)->int:
+        """Polls the SRQ line with ++srq, which costs no device transaction, and only serial polls this
+           instrument once the line is asserted. The interval backs off while the line stays idle."""
+        wanted = (expected,) if isinstance(expected, int) else tuple(expected)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = self.minInterval
+        while True:
+            if await self._srq_line():
+                status = await self.read_stb()
+                if status & RQS:
+                    if status in wanted:
+                        return status
+                    print(f"SRQ asserted, but not {' or '.join(map(hex, wanted))} (status byte = {hex(status)}). Waiting...")
+                interval = self.minInterval
+            if stopEvent is not None and stopEvent.is_set():
+                return None
+            if deadline is not None and time.monotonic() + interval > deadline:
+                raise TimeoutError("Timed out waiting for SRQ")
+            await asyncio.sleep(interval)
+            interval = min(self.maxInterval, interval * 1.5)
+
+def _escape(msg: str)->str:
+    """Escapes the characters the adapter would otherwise interpret."""
+    return msg.replace('\x1b', '\x1b\x1b').replace('+', '\x1b+')
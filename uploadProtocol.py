@@ -0,0 +1,159 @@
+import json
+import struct
+import zlib
+
+# Frame types, deliberately non-printable so they can't be confused with legacy text uploads
+FRAME_HEADER = 0x01
+FRAME_DATA = 0x02
+FRAME_ABORT = 0x03
+
+VERSION = 1
+FLAG_ZLIB = 0x01
+
+# type, version, flags, total length, chunk count, crc32 of the transmitted payload, chunk size
+HEADER = struct.Struct('<BBBIIIH')
+# type, sequence number, followed by the chunk payload
+DATA = struct.Struct('<BI')
+
+MAX_UPLOAD = 64 * 1024 * 1024
+
+IDLE = "idle"
+RECEIVING = "receiving"
+COMPLETE = "complete"
+ERROR = "error"
+
+def is_frame(value)->bool:
+    return len(value) > 0 and value[0] in (FRAME_HEADER, FRAME_DATA, FRAME_ABORT)
+
+def split_ids(payload: bytes)->list:
+    """IDs are separated by commas or newlines."""
+    text = payload.decode('utf-8').replace('\n', ',')
+    return [i.strip() for i in text.split(',') if i.strip()]
+
+class UploadAssembler:
+    """Reassembles a framed upload.
+       The header announces the total length, chunk count, chunk size and CRC so the buffer is allocated once,
+       each numbered chunk is copied straight to its offset, and duplicates or reordering are harmless.
+       Once every chunk is in, the CRC is checked, the payload is optionally inflated and on_complete(ids) is called."""
+    def __init__(self, on_complete=None):
+        self.on_complete = on_complete
+        self.reset()
+
+    def reset(self):
+        self.state = IDLE
+        self.error = None
+        self._buffer = None
+        self._received = None
+        self._receivedCount = 0
+        self._chunks = 0
+        self._chunkSize = 0
+        self._length = 0
+        self._crc = 0
+        self._flags = 0
+        self.count = 0
+
+    def feed(self, value):
+        """Handles one written frame."""
+        frame = bytes(value)
+        if not frame:
+            return
+        kind = frame[0]
+        if kind == FRAME_HEADER:
+            self._start(frame)
+        elif kind == FRAME_DATA:
+            self._chunk(frame)
+        elif kind == FRAME_ABORT:
+            self.reset()
+
+    def _fail(self, msg: str):
+        print(f"Upload failed: {msg}")
+        self.state = ERROR
+        self.error = msg
+        self._buffer = None
+        self._received = None
+
+    def _start(self, frame: bytes):
+        self.reset()
+        if len(frame) < HEADER.size:
+            return self._fail("short header")
+        _, version, flags, length, chunks, crc, chunkSize = HEADER.unpack_from(frame)
+        if version != VERSION:
+            return self._fail(f"unsupported version {version}")
+        if length > MAX_UPLOAD or chunkSize == 0 or chunks != (length + chunkSize - 1) // chunkSize:
+            return self._fail("inconsistent header")
+        self.state = RECEIVING
+        self._flags = flags
+        self._length = length
+        self._chunks = chunks
+        self._chunkSize = chunkSize
+        self._crc = crc
+        self._buffer = bytearray(length)
+        self._received = bytearray(chunks)
+        if chunks == 0:
+            self._finish()
+
+    def _chunk(self, frame: bytes):
+        if self.state != RECEIVING:
+            return
+        if len(frame) < DATA.size:
+            return self._fail("short data frame")
+        _, seq = DATA.unpack_from(frame)
+        data = memoryview(frame)[DATA.size:]
+        if seq >= self._chunks:
+            return self._fail(f"chunk {seq} out of range")
+        offset = seq * self._chunkSize
+        expected = min(self._chunkSize, self._length - offset)
+        if len(data) != expected:
+            return self._fail(f"chunk {seq} has {len(data)} bytes, expected {expected}")
+        if not self._received[seq]:
+            self._received[seq] = 1
+            self._receivedCount += 1
+        self._buffer[offset:offset + expected] = data
+        if self._receivedCount == self._chunks:
+            self._finish()
+
+    def _finish(self):
+        if zlib.crc32(self._buffer) != self._crc:
+            return self._fail("CRC mismatch")
+        try:
+            payload = zlib.decompress(self._buffer) if self._flags & FLAG_ZLIB else bytes(self._buffer)
+            ids = split_ids(payload)
+        except (zlib.error, UnicodeDecodeError) as e:
+            return self._fail(f"bad payload: {e}")
+        self._buffer = None
+        self.state = COMPLETE
+        self.count = len(ids)
+        print(f"Upload complete: {self.count} IDs")
+        if self.on_complete is not None:
+            self.on_complete(ids)
+
+    def missing(self, limit: int = 20)->list:
+        """First few chunk numbers not received yet, so a client can resend them."""
+        if self._received is None:
+            return []
+        return [seq for seq in range(self._chunks) if not self._received[seq]][:limit]
+
+    def get_payload(self, **extra)->bytes:
+        """Ack/status record for the client as UTF-8 JSON."""
+        return json.dumps({
+            **extra,
+            "state": self.state,
+            "received": self._receivedCount,
+            "chunks": self._chunks,
+            "missing": self.missing(),
+            "ids": self.count,
+            "error": self.error,
+        }).encode('utf-8')
+
+def encode_upload(ids, chunkSize: int, compress: bool = True)->list:
+    """Client side helper that frames a list of IDs into header and chunk writes."""
+    payload = ','.join(ids).encode('utf-8')
+    flags = 0
+    if compress:
+        payload = zlib.compress(payload, 9)
+        flags |= FLAG_ZLIB
+    chunks = (len(payload) + chunkSize - 1) // chunkSize
+    frames = [HEADER.pack(FRAME_HEADER, VERSION, flags, len(payload), chunks, zlib.crc32(payload), chunkSize)]
+    for seq in range(chunks):
+        frames.append(DATA.pack(FRAME_DATA, seq) + payload[seq * chunkSize:(seq + 1) * chunkSize])
+    return frames